@@ -0,0 +1,293 @@
+import concurrent.futures
+import datetime
+import functools
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+import uuid
+from argparse import ArgumentParser
+
+from m4m_sync.encrypt import AesStreamWrapper, KeyManager
+from m4m_sync.serializers import CsvRawSerializer, CsvVerboseSerializer
+from m4m_sync.stores import BaseStore, LocalStore, WebDavStore
+
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] [%(name)s] %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+KEY = "benchmark-key"
+
+CASES = {}
+
+
+def case(name: str):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+class Row:
+    # shaped like database.SensorData, which is all the serializers look at
+    def __init__(self, data: dict, signer: bytes, sign: bytes):
+        self.data = data
+        self.signer = signer
+        self.sign = sign
+
+
+def generate_rows(size: int, multi_value: bool) -> typing.List[Row]:
+    start = datetime.datetime(2020, 1, 1)
+    step = datetime.timedelta(days=1) / size
+    signer = os.urandom(32)
+
+    rows = []
+    for i in range(size):
+        value = {"temperature": 20 + i % 100 / 10, "humidity": 40 + i % 50, "status": "ok"} if multi_value \
+            else 20 + i % 100 / 10
+        rows.append(Row(
+            data={"timestamp": (start + step * i).isoformat(), "value": value},
+            signer=signer,
+            sign=os.urandom(64),
+        ))
+    return rows
+
+
+def serialize(serializer, rows: typing.List[Row]) -> bytes:
+    stream = io.BytesIO()
+    serializer.serialize(stream, rows)
+    return stream.getvalue()
+
+
+def encrypt(data: bytes, mode: str) -> bytes:
+    stream = io.BytesIO()
+    wrapper = AesStreamWrapper(key=KeyManager(KEY), mode=mode)(stream)
+    wrapper.write(data)
+    wrapper.close()
+    return stream.getvalue()
+
+
+def decrypt(data: bytes, mode: str) -> bytes:
+    return AesStreamWrapper(key=KeyManager(KEY), mode=mode)(io.BytesIO(data)).read()
+
+
+def setup_serialize(serializer_factory, multi_value: bool, size: int, options: dict):
+    rows = generate_rows(size, multi_value)
+    return functools.partial(serialize, serializer_factory(), rows), len(serialize(serializer_factory(), rows)), size, None
+
+
+for _multi_value in (False, True):
+    _kind = "dict" if _multi_value else "scalar"
+    case("serialize/csv_raw/{}".format(_kind))(functools.partial(setup_serialize, CsvRawSerializer, _multi_value))
+    case("serialize/csv_verbose/{}".format(_kind))(functools.partial(setup_serialize, CsvVerboseSerializer, _multi_value))
+
+
+def setup_aes(mode: str, direction: str, size: int, options: dict):
+    data = serialize(CsvRawSerializer(), generate_rows(size, False))
+    if direction == "write":
+        return functools.partial(encrypt, data, mode), len(data), size, None
+
+    encrypted = encrypt(data, mode)
+    return functools.partial(decrypt, encrypted, mode), len(data), size, None
+
+
+for _mode in (AesStreamWrapper.MODE_GCM, AesStreamWrapper.MODE_CBC):
+    for _direction in ("write", "read"):
+        case("aes/{}/{}".format(_mode, _direction))(functools.partial(setup_aes, _mode, _direction))
+
+
+def create_store(backend: str, options: dict) -> typing.Tuple[BaseStore, str]:
+    folder = "benchmark-{}".format(uuid.uuid4().hex)
+    if backend == "local":
+        store = LocalStore(root=options["root"])
+    else:
+        store = WebDavStore(
+            uri=options["webdav_uri"],
+            port=options["webdav_port"],
+            protocol=options["webdav_protocol"],
+            username=options["webdav_username"],
+            password=options["webdav_password"],
+        )
+    store._create_folder(folder)
+    return store, folder
+
+
+def upload(store: BaseStore, path: str, data: bytes):
+    store._upload(io.BytesIO(data), path)
+
+
+def download(store: BaseStore, path: str) -> bytes:
+    with store._get_download_stream(path) as stream:
+        return stream.read()
+
+
+def setup_store(backend: str, operation: str, size: int, options: dict):
+    store, folder = create_store(backend, options)
+    # local folders go away with the temporary root, remote ones have to be deleted
+    cleanup = functools.partial(store._rm, folder) if backend == "webdav" else None
+    data = encrypt(serialize(CsvRawSerializer(), generate_rows(size, False)), AesStreamWrapper.MODE_GCM)
+    path = "{}/2020.1.1.m4m".format(folder)
+
+    try:
+        if operation == "upload":
+            return functools.partial(upload, store, path, data), len(data), size, cleanup
+        if operation == "download":
+            upload(store, path, data)
+            return functools.partial(download, store, path), len(data), size, cleanup
+
+        # a folder holds a file per partition, the size stands for the number of files here
+        files = min(size, options["max_ls_files"])
+        for day in range(files):
+            upload(store, "{}/{}.m4m".format(folder, day), b"")
+        return functools.partial(store._ls, folder), 0, files, cleanup
+    except BaseException:
+        if cleanup is not None:
+            cleanup()
+        raise
+
+
+for _backend in ("local", "webdav"):
+    for _operation in ("ls", "upload", "download"):
+        case("store/{}/{}".format(_backend, _operation))(functools.partial(setup_store, _backend, _operation))
+
+
+def measure(name: str, size: int, repeat: int, options: dict) -> dict:
+    run, payload, rows, cleanup = CASES[name](size, options)
+    try:
+        run()
+
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+
+        tracemalloc.start()
+        run()
+        _, allocated = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+    seconds = min(timings)
+    return {
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds,
+        "mb_per_second": payload / MB / seconds,
+        "allocated_mb": allocated / MB,
+        # linux reports kilobytes, macos bytes
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (MB if sys.platform == "darwin" else 1024),
+    }
+
+
+def run_isolated(name: str, size: int, repeat: int, options: dict) -> dict:
+    # a fresh interpreter per case keeps peak RSS from carrying over between cases
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(measure, name, size, repeat, options).result()
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> typing.List[str]:
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+
+        speed = result["rows_per_second"] / base["rows_per_second"] - 1
+        rss = result["peak_rss_mb"] / base["peak_rss_mb"] - 1
+        regressed = speed < -threshold or rss > threshold
+        logger.info(
+            "%-40s throughput %+7.1f%%  peak rss %+7.1f%%%s",
+            key,
+            speed * 100,
+            rss * 100,
+            "  REGRESSION" if regressed else "",
+        )
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--case", action="append", choices=sorted(CASES), help="default: all local cases")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-ls-files", type=int, default=1000)
+    parser.add_argument("--webdav-uri", required=False)
+    parser.add_argument("--webdav-port", type=int, default=0)
+    parser.add_argument("--webdav-protocol", required=False)
+    parser.add_argument("--webdav-username")
+    parser.add_argument("--webdav-password")
+    parser.add_argument("--save", help="write the results to this file to use them as a baseline")
+    parser.add_argument("--compare", help="baseline file to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args()
+
+    names = args.case or [name for name in sorted(CASES) if args.webdav_uri or "/webdav/" not in name]
+    sizes = [int(size) for size in args.sizes.split(",")]
+    root = tempfile.mkdtemp(prefix="m4m-benchmark-")
+    options = {
+        "root": root,
+        "max_ls_files": args.max_ls_files,
+        "webdav_uri": args.webdav_uri,
+        "webdav_port": args.webdav_port,
+        "webdav_protocol": args.webdav_protocol,
+        "webdav_username": args.webdav_username,
+        "webdav_password": args.webdav_password,
+    }
+
+    results = {}
+    try:
+        for name in names:
+            for size in sizes:
+                key = "{}/{}".format(name, size)
+                results[key] = result = run_isolated(name, size, args.repeat, options)
+                logger.info(
+                    "%-40s %10.0f rows/s %8.1f MB/s %8.1f MB allocated %8.1f MB peak rss",
+                    key,
+                    result["rows_per_second"],
+                    result["mb_per_second"],
+                    result["allocated_mb"],
+                    result["peak_rss_mb"],
+                )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            logger.error("%d case(s) regressed by more than %.0f%%", len(regressions), args.threshold * 100)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 import datetime
+import itertools
+import logging
+import os
+import threading
 import typing
 
 from sqlalchemy import (
     and_,
+    or_,
     create_engine,
     Column,
     ForeignKey,
@@ -10,13 +15,21 @@ from sqlalchemy import (
     Integer,
     String,
     DateTime,
+    cast,
+    func,
+    literal_column,
+    text,
 )
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker, Session
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import JSON, aggregate_order_by
 
+from m4m_sync.metrics import registry
 from m4m_sync.utils import DateTimeRange
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 
@@ -58,6 +71,25 @@ class SensorData(Base):
     )
 
 
+# a plain ::timestamp cast is only STABLE, postgres refuses to index it; the ISO timestamps written by the
+# controllers parse the same under every DateStyle, so the wrapper is safe to declare IMMUTABLE
+TIMESTAMP_FUNCTION = "m4m_sensor_data_timestamp"
+TIMESTAMP_FUNCTION_DDL = text("""
+    CREATE OR REPLACE FUNCTION {}(data json) RETURNS timestamp
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT (data ->> 'timestamp')::timestamp $$
+""".format(TIMESTAMP_FUNCTION))
+
+# plain DDL rather than an Index on the table: a concurrent build cannot be part of metadata.create_all's transaction
+TIMESTAMP_INDEX = "ix_sensor_data_sensor_id_timestamp"
+TIMESTAMP_INDEX_DDL = text("CREATE INDEX CONCURRENTLY {} ON {} (sensor_id, {}(data))".format(
+    TIMESTAMP_INDEX,
+    SensorData.__tablename__,
+    TIMESTAMP_FUNCTION,
+))
+TIMESTAMP_INDEX_DROP_DDL = text("DROP INDEX CONCURRENTLY IF EXISTS {}".format(TIMESTAMP_INDEX))
+
+
 class UserInfo(Base):
     __tablename__ = "users_info"
 
@@ -72,14 +104,118 @@ class UserSocialTokens(Base):
     yandex_disk = Column(String)
 
 
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(db_uri: str, pool_size: int = 5, max_overflow: int = 10) -> Engine:
+    # keyed by pid as well: pooled connections inherited by a forked worker must not be shared with the parent,
+    # and by the pool limits, the first caller must not fix them for a later one that sized the pool for its workers
+    key = os.getpid(), db_uri, pool_size, max_overflow
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = create_engine(
+                db_uri,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=True,
+                pool_recycle=3600,
+            )
+        return _engines[key]
+
+
+class SyncPlanItem:
+    def __init__(
+            self,
+            controller: Controller,
+            sensor: typing.Optional[Sensor],
+            first_date: typing.Optional[datetime.datetime],
+            last_date: typing.Optional[datetime.datetime],
+            count: int,
+    ):
+        self.controller = controller
+        self.sensor = sensor
+        self.first_date = first_date
+        self.last_date = last_date
+        self.count = count
+
+    @property
+    def watermark(self) -> typing.Tuple[typing.Optional[datetime.datetime], int]:
+        return self.last_date, self.count
+
+
 class DatabaseManager:
-    def __init__(self, db_uri):
+    def __init__(self, db_uri, pool_size: int = 5, max_overflow: int = 10):
         self._db_uri = db_uri
+        self.__engine = get_engine(db_uri, pool_size=pool_size, max_overflow=max_overflow)
+        # one session per thread, so workers sharing a manager never share a connection or an identity map
+        self.__sessions = scoped_session(sessionmaker(bind=self.__engine))
+        self.__timestamp_indexed = None
+
+    def _create_session(self) -> Session:
+        return self.__sessions()
+
+    def close_session(self):
+        self.__sessions.remove()
+
+    @staticmethod
+    def __detach(session: Session, row):
+        # rows are fully loaded, dropping them from the identity map keeps a long backfill flat
+        session.expunge(row)
+        return row
+
+    def _timestamp_index_state(self) -> typing.Optional[bool]:
+        # None when missing; False when a failed or interrupted concurrent build left it INVALID
+        row = self._create_session().execute(
+            text(
+                "SELECT i.indisvalid FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "JOIN pg_class t ON t.oid = i.indrelid "
+                "WHERE t.relname = :table AND c.relname = :index"
+            ),
+            {"table": SensorData.__tablename__, "index": TIMESTAMP_INDEX},
+        ).first()
+        return row[0] if row is not None else None
+
+    def has_timestamp_index(self) -> bool:
+        if self.__timestamp_indexed is None:
+            self.__timestamp_indexed = self._timestamp_index_state() is True
+        return self.__timestamp_indexed
+
+    def check_timestamp_index(self) -> bool:
+        if not self.has_timestamp_index():
+            logger.warning(
+                "index %s is missing, sensor data will be read with sequential scans; "
+                "create it with --create-index",
+                TIMESTAMP_INDEX,
+            )
+        return self.__timestamp_indexed
+
+    def create_timestamp_index(self):
+        state = self._timestamp_index_state()
+        # a concurrent build waits for every open transaction, including the one that just looked the index up
+        self.close_session()
+        if state is True:
+            self.__timestamp_indexed = True
+            return
 
-    def _create_session(self):
-        if not hasattr(self, "__session"):
-            setattr(self, "__session", Session(create_engine(self._db_uri)))
-        return getattr(self, "__session")
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        with self.__engine.connect() as connection:
+            connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+            if state is False:
+                logger.warning("index %s is invalid, rebuilding it", TIMESTAMP_INDEX)
+                connection.execute(TIMESTAMP_INDEX_DROP_DDL)
+
+            logger.info("creating index %s", TIMESTAMP_INDEX)
+            connection.execute(TIMESTAMP_FUNCTION_DDL)
+            connection.execute(TIMESTAMP_INDEX_DDL)
+        self.__timestamp_indexed = True
+
+    def _timestamp(self):
+        # the planner only matches the index when a query repeats the indexed expression exactly
+        if self.has_timestamp_index():
+            return getattr(func, TIMESTAMP_FUNCTION)(SensorData.data, type_=DateTime)
+        return SensorData.data["timestamp"].astext.cast(DateTime)
 
     def get_controllers(self) -> typing.List[Controller]:
         return self._create_session().query(Controller).all()
@@ -87,24 +223,131 @@ class DatabaseManager:
     def get_sensors(self, controller: Controller) -> typing.List[Sensor]:
         return self._create_session().query(Sensor).filter_by(controller_id=controller.id).all()
 
+    @registry.timed("db_query", query="sensor_data")
     def get_sensor_data(self, sensor_id: str, datetime_range: DateTimeRange) -> typing.List[SensorData]:
-        return self._create_session().query(SensorData).filter(
+        session = self._create_session()
+        timestamp = self._timestamp()
+        return [self.__detach(session, row) for row in session.query(SensorData).filter(
             and_(
                 SensorData.sensor_id == sensor_id,
-                SensorData.data["timestamp"].astext.cast(DateTime) >= datetime_range.start,
-                SensorData.data["timestamp"].astext.cast(DateTime) <= datetime_range.end,
+                timestamp >= datetime_range.start,
+                timestamp <= datetime_range.end,
             ),
-        ).all()
+        )]
+
+    def get_sensor_data_by_partitions(
+            self,
+            sensor_id: str,
+            ranges: typing.Iterable[DateTimeRange],
+            granularity: str = "day",
+            batch_size: int = 1000,
+            lazy: bool = False,
+    ) -> typing.Iterator[typing.Tuple[DateTimeRange, typing.Iterable[SensorData]]]:
+        spans = DateTimeRange.merge(ranges)
+        if not spans:
+            return
+
+        partition = getattr(DateTimeRange, granularity)
+        session = self._create_session()
+        timestamp = self._timestamp()
+        # yield_per streams through a server-side cursor instead of buffering the whole result
+        query = session.query(SensorData, timestamp).filter(
+            and_(
+                SensorData.sensor_id == sensor_id,
+                or_(*[and_(timestamp >= span.start, timestamp <= span.end) for span in spans]),
+            ),
+        ).order_by(timestamp).yield_per(batch_size)
+
+        results = registry.timed_iter(query, "db_query", query="partitions")
+        for start, rows in itertools.groupby(results, key=lambda row: partition(row[1]).start):
+            # a lazy group is only valid until the next one is requested
+            rows = (self.__detach(session, row[0]) for row in rows)
+            yield partition(start), rows if lazy else list(rows)
+
+    def get_sensor_data_by_days(
+            self,
+            sensor_id: str,
+            ranges: typing.Iterable[DateTimeRange],
+            batch_size: int = 1000,
+            lazy: bool = False,
+    ) -> typing.Iterator[typing.Tuple[DateTimeRange, typing.Iterable[SensorData]]]:
+        return self.get_sensor_data_by_partitions(sensor_id, ranges, batch_size=batch_size, lazy=lazy)
 
+    @registry.timed("db_query", query="first_date")
     def get_first_sensor_data_date(self, sensor_id: str) -> datetime.datetime:
-        data = self._create_session().query(SensorData.data["timestamp"].astext.cast(DateTime)) \
+        timestamp = self._timestamp()
+        data = self._create_session().query(timestamp) \
             .filter(SensorData.sensor_id == sensor_id) \
-            .order_by(SensorData.id.asc()) \
+            .order_by(timestamp.asc()) \
             .limit(1) \
             .all()
         if len(data):
             return data[0][0]
 
+    @registry.timed("db_query", query="watermark")
+    def get_sensor_data_watermark(self, sensor_id: str) -> typing.Tuple[typing.Optional[datetime.datetime], int]:
+        last, count = self._create_session().query(
+            func.max(self._timestamp()),
+            func.count(SensorData.id),
+        ).filter(SensorData.sensor_id == sensor_id).one()
+        return last, count
+
+    @registry.timed("db_query", query="fingerprints")
+    def get_sensor_data_fingerprints(
+            self,
+            sensor_id: str,
+            since: datetime.datetime = None,
+            granularity: str = "day",
+            checksum_since: datetime.datetime = None,
+    ) -> typing.Dict[datetime.datetime, typing.Tuple[int, int, typing.Optional[str]]]:
+        timestamp = self._timestamp()
+        partition = func.date_trunc(granularity, timestamp)
+        # ordered by id so the checksum only changes when the rows of the partition do
+        row_hash = cast(SensorData.id, String) + func.md5(cast(SensorData.data, String))
+        rows = func.string_agg(row_hash, aggregate_order_by(literal_column("','"), SensorData.id))
+        if checksum_since is not None:
+            # hashing every row on each run is what makes a full pass expensive, older partitions get a NULL
+            # checksum and are compared by count and max id alone
+            rows = rows.filter(timestamp >= getattr(DateTimeRange, granularity)(checksum_since).start)
+        checksum = func.md5(rows)
+
+        query = self._create_session().query(partition, func.count(SensorData.id), func.max(SensorData.id), checksum) \
+            .filter(SensorData.sensor_id == sensor_id)
+        if since is not None:
+            # a fingerprint over part of a partition would never match the one stored for the whole file
+            query = query.filter(timestamp >= getattr(DateTimeRange, granularity)(since).start)
+
+        return {row[0]: tuple(row[1:]) for row in query.group_by(partition).all()}
+
+    @registry.timed("db_query", query="sync_plan")
+    def get_sync_plan(self) -> typing.List[SyncPlanItem]:
+        session = self._create_session()
+        timestamp = self._timestamp()
+
+        stats = {
+            sensor_id: (first_date, last_date, count)
+            for sensor_id, first_date, last_date, count in session.query(
+                SensorData.sensor_id,
+                func.min(timestamp),
+                func.max(timestamp),
+                func.count(SensorData.id),
+            ).group_by(SensorData.sensor_id)
+        }
+
+        # sensors.controller_id is an integer column while controllers.id is a string
+        rows = session.query(Controller, Sensor) \
+            .outerjoin(Sensor, cast(Sensor.controller_id, String) == Controller.id) \
+            .order_by(Controller.id) \
+            .all()
+
+        plan = [
+            SyncPlanItem(controller, sensor, *stats.get(sensor.id if sensor else None, (None, None, 0)))
+            for controller, sensor in rows
+        ]
+        # the largest sensors are started first so a worker pool does not end on one long tail
+        plan.sort(key=lambda item: -item.count)
+        return plan
+
     def get_encryption_key(self):
         key, = self._create_session().query(UserInfo.encrypt_key).one()
         return key
@@ -1,3 +1,10 @@
-from .serializers import BaseSerializer, CsvRawSerializer
+from .serializers import BaseSerializer, CsvRawSerializer, Record
 from .stores import BaseStore, LocalStore, WebDavStore, YaDiskStore
-from .encrypt import AesStreamWrapper
+from .encrypt import AesStreamWrapper, AesGcmStreamWrapper, KeyManager
+from .scheduler import SyncScheduler
+from .manifest import SyncManifest
+from .cache import CachedStore
+from .compress import GzipStreamWrapper, ZstdStreamWrapper, Lz4StreamWrapper, AutoDecompressStreamWrapper
+from .utils import StreamWrapperChain, StreamWrapperPipeline
+from .metrics import Metrics
+from .daemon import SyncDaemon
@@ -0,0 +1,323 @@
+import asyncio
+import datetime
+import io
+import logging
+import os
+import typing
+import urllib.parse
+import xml.etree.ElementTree
+
+import aiohttp
+
+from m4m_sync.compress import AutoDecompressStreamWrapper
+from m4m_sync.serializers import BaseSerializer
+from m4m_sync.stores import (
+    PARTITION_DAY,
+    Controller,
+    DirectoryIndex,
+    File,
+    Sensor,
+    find_partitions,
+    get_file_name_for_day,
+    get_sync_days,
+)
+from m4m_sync.utils import DateTimeRange, StreamWrapper
+
+logger = logging.getLogger(__name__)
+
+
+# library only, the sync_*/read_* scripts use the blocking stores
+class AsyncBaseStore:
+    ROOT = "M4M"
+    __SENSOR_NAME_PREFIX = "."
+    __CONTROLLER_NAME_PREFIX = "."
+
+    def __init__(self, max_in_flight: int = 32):
+        self.max_in_flight = max_in_flight
+        self.__index = DirectoryIndex()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self):
+        if await self.__find("/", self.ROOT) is None:
+            logger.info("creating root folder")
+            await self.__create_folder(self.ROOT)
+
+    async def close(self):
+        pass
+
+    def invalidate(self, *paths: str):
+        if paths:
+            self.__index.invalidate(self.__join(*paths))
+        else:
+            self.__index.invalidate()
+
+    async def refresh(self, *paths: str):
+        self.invalidate(*paths)
+        await self.__ls(self.__join(*paths))
+
+    async def _upload(self, stream: io.IOBase, path: str):
+        raise NotImplementedError
+
+    async def _get_download_stream(self, path: str) -> io.IOBase:
+        raise NotImplementedError
+
+    async def _create_folder(self, path: str):
+        raise NotImplementedError
+
+    async def _ls(self, path: str) -> typing.List[File]:
+        raise NotImplementedError
+
+    async def _rm(self, path: str):
+        raise NotImplementedError
+
+    async def __ls(self, path: str) -> typing.List[File]:
+        files = self.__index.get(path)
+        if files is None:
+            files = await self._ls(path)
+            self.__index.set(path, files)
+        return files
+
+    async def __find(self, path: str, name: str) -> typing.Optional[File]:
+        if not self.__index.is_listed(path):
+            await self.__ls(path)
+        return self.__index.find(path, name)
+
+    async def __upload(self, stream: io.IOBase, path: str):
+        await self._upload(stream, path)
+        self.__index.add(path, is_dir=False)
+
+    async def __create_folder(self, path: str):
+        await self._create_folder(path)
+        self.__index.add(path, is_dir=True)
+
+    async def __rm(self, path: str):
+        await self._rm(path)
+        self.__index.remove(path)
+
+    def __join(self, *paths: str) -> str:
+        return os.path.join(self.ROOT, *paths)
+
+    async def __prepare_name_file(self, path: str, prefix: str, name: str):
+        files = await self.__ls(path)
+        name_file = next((file for file in files if file.name.startswith(prefix)), None)
+
+        if name_file and name_file.name[1:] == name:
+            return
+        if name_file:
+            await self.__rm(os.path.join(path, name_file.name))
+        await self.__upload(io.BytesIO(), os.path.join(path, prefix + name))
+
+    async def prepare_for_sync_controller(self, controller: Controller):
+        path = self.__join(str(controller))
+        if await self.__find(self.__join(), str(controller)) is None:
+            await self.__create_folder(path)
+
+        await self.__prepare_name_file(path, self.__CONTROLLER_NAME_PREFIX, controller.name)
+
+    async def prepare_for_sync_sensor(self, sensor: Sensor):
+        path = self.__join(str(sensor.controller), str(sensor))
+        if await self.__find(self.__join(str(sensor.controller)), str(sensor)) is None:
+            await self.__create_folder(path)
+
+        await self.__prepare_name_file(path, self.__SENSOR_NAME_PREFIX, sensor.name)
+
+    async def __sync_day(
+            self,
+            path: str,
+            data: list,
+            context: str,
+            serializer: BaseSerializer,
+            stream_wrapper_factory: typing.Callable[[], StreamWrapper],
+            executor,
+            semaphore: asyncio.Semaphore,
+    ):
+        def convert() -> io.BytesIO:
+            temp_stream = io.BytesIO()
+            with stream_wrapper_factory(context=context)(stream=temp_stream) as wrapped_stream:
+                serializer.serialize(out_stream=wrapped_stream, data=data)
+            temp_stream.seek(0)
+            return temp_stream
+
+        try:
+            logger.info("Converting %s", path)
+            temp_stream = await asyncio.get_running_loop().run_in_executor(executor, convert)
+
+            logger.info("Saving %s", path)
+            await self.__upload(temp_stream, path)
+        finally:
+            semaphore.release()
+
+    async def sync(
+            self,
+            sensor: Sensor,
+            serializer: BaseSerializer,
+            stream_wrapper_factory: typing.Callable[[], StreamWrapper],
+            first_date: datetime.datetime,
+            get_data_by_days,
+            executor=None,
+    ):
+        # only whole missing days are synced here, other granularities need the manifest driven BaseStore.sync
+        if sensor.partition != PARTITION_DAY:
+            raise ValueError("{} partitions are not supported by {}".format(sensor.partition, type(self).__name__))
+
+        loop = asyncio.get_running_loop()
+        sensor_path = self.__join(str(sensor.controller), str(sensor))
+
+        missing_days = []
+        for current_range in get_sync_days(first_date):
+            if await self.__find(sensor_path, get_file_name_for_day(current_range.start)) is None:
+                missing_days.append(current_range)
+
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        days = await loop.run_in_executor(executor, lambda: iter(get_data_by_days(missing_days)))
+        tasks = []
+
+        try:
+            while True:
+                day = await loop.run_in_executor(executor, next, days, None)
+                if day is None:
+                    break
+
+                current_range, data = day
+                if not data:
+                    continue
+
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(self.__sync_day(
+                    path=os.path.join(sensor_path, get_file_name_for_day(current_range.start)),
+                    data=data,
+                    context=sensor.id,
+                    serializer=serializer,
+                    stream_wrapper_factory=stream_wrapper_factory,
+                    executor=executor,
+                    semaphore=semaphore,
+                )))
+        finally:
+            await asyncio.gather(*tasks)
+
+    async def __get_day(
+            self,
+            path: str,
+            stream_wrapper_factory: typing.Callable[[], StreamWrapper],
+            executor,
+            semaphore: asyncio.Semaphore,
+    ) -> bytes:
+        def decode(file: io.IOBase) -> bytes:
+            stream = stream_wrapper_factory()(file) if stream_wrapper_factory else file
+            with AutoDecompressStreamWrapper()(stream) as stream:
+                return stream.read()
+
+        async with semaphore:
+            file = await self._get_download_stream(path)
+        with file:
+            return await asyncio.get_running_loop().run_in_executor(executor, decode, file)
+
+    async def get(
+            self,
+            sensor: Sensor,
+            range: DateTimeRange,
+            stream_wrapper_factory: typing.Callable[[], StreamWrapper],
+            executor=None,
+    ) -> typing.List[bytes]:
+        sensor_path = self.__join(str(sensor.controller), str(sensor))
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        paths = [
+            os.path.join(sensor_path, file_name)
+            for file_name in find_partitions(await self.__ls(sensor_path), range)
+        ]
+
+        return list(await asyncio.gather(*[
+            self.__get_day(path, stream_wrapper_factory, executor, semaphore) for path in paths
+        ]))
+
+
+class AsyncWebDavStore(AsyncBaseStore):
+    def __init__(
+            self,
+            uri: str,
+            protocol: str = None,
+            port: int = None,
+            username: str = None,
+            password: str = None,
+            headers: dict = None,
+            *args,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+
+        protocol = protocol or "http"
+        port = port or (443 if protocol == "https" else 80)
+        self.__base_url = "{protocol}://{uri}:{port}".format(protocol=protocol, uri=uri.strip("/"), port=port)
+        self.__auth = aiohttp.BasicAuth(username, password) if username else None
+        self.__headers = headers
+        self.__session = None
+
+    async def open(self):
+        self.__session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+            auth=self.__auth,
+            headers=self.__headers,
+        )
+        await super().open()
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    def __url(self, path: str) -> str:
+        return "{}/{}".format(self.__base_url, urllib.parse.quote(path.strip("/")))
+
+    async def __send(self, method: str, path: str, expected_codes: typing.Tuple[int, ...], **kwargs) -> bytes:
+        async with self.__session.request(method, self.__url(path), **kwargs) as response:
+            body = await response.read()
+            if response.status not in expected_codes:
+                raise aiohttp.ClientResponseError(
+                    response.request_info,
+                    response.history,
+                    status=response.status,
+                    message="{} {}".format(method, path),
+                )
+            return body
+
+    async def _ls(self, path: str) -> typing.List[File]:
+        body = await self.__send("PROPFIND", path, (207,), headers={"Depth": "1"})
+        own_path = "/" + path.strip("/")
+
+        result = []
+        for response in xml.etree.ElementTree.fromstring(body).iter("{DAV:}response"):
+            href = urllib.parse.unquote(urllib.parse.urlparse(response.findtext("{DAV:}href")).path)
+            if href.rstrip("/") == own_path.rstrip("/"):
+                continue
+            result.append(File(name=os.path.basename(href.strip("/")), is_dir=href.endswith("/")))
+        return result
+
+    async def _create_folder(self, path: str):
+        await self.__send("MKCOL", path, (201,))
+
+    async def _rm(self, path: str):
+        await self.__send("DELETE", path, (200, 204))
+
+    async def _upload(self, stream: io.IOBase, path: str):
+        await self.__send("PUT", path, (200, 201, 204), data=stream.read())
+
+    async def _get_download_stream(self, path: str) -> io.IOBase:
+        return io.BytesIO(await self.__send("GET", path, (200,)))
+
+
+class AsyncYaDiskStore(AsyncWebDavStore):
+    def __init__(self, token: str, *args, **kwargs):
+        super().__init__(
+            uri="webdav.yandex.ru",
+            protocol="https",
+            headers={"Authorization": "Bearer " + token},
+            *args,
+            **kwargs,
+        )
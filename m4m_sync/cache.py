@@ -0,0 +1,152 @@
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+import typing
+
+from m4m_sync.stores import BaseStore, File
+
+logger = logging.getLogger(__name__)
+
+
+class CachedStore(BaseStore):
+    DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+    def __init__(self, store: BaseStore, root: str, max_size: int = DEFAULT_MAX_SIZE, *args, **kwargs):
+        self.__store = store
+        self.__root = root
+        self.__max_size = max_size
+        self.__lock = threading.Lock()
+        self.__size = 0
+        os.makedirs(root, exist_ok=True)
+        self.__evict()
+        super().__init__(*args, **kwargs)
+
+    @staticmethod
+    def __validator(file: typing.Optional[File]) -> typing.Optional[str]:
+        if file is None:
+            return None
+        if file.etag:
+            return file.etag
+        if file.size is not None and file.mtime is not None:
+            return "{}-{}".format(file.size, file.mtime)
+
+    def __entry_dir(self, path: str) -> str:
+        return os.path.join(self.__root, hashlib.sha256(path.strip("/").encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def __entry_name(validator: str) -> str:
+        return validator.encode("utf-8").hex()
+
+    def __latest_entry(self, entry_dir: str) -> typing.Optional[str]:
+        try:
+            with os.scandir(entry_dir) as entries:
+                entries = [entry for entry in entries if entry.is_file() and not entry.name.endswith(".part")]
+        except FileNotFoundError:
+            return None
+        if entries:
+            return max(entries, key=lambda entry: entry.stat().st_mtime).name
+
+    def __hit(self, path: str) -> io.IOBase:
+        # the modification time doubles as the last access time for eviction
+        os.utime(path)
+        return open(path, "rb")
+
+    def __put(self, entry_dir: str, validator: str, stream: io.IOBase) -> io.IOBase:
+        data = stream.read()
+        os.makedirs(entry_dir, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=entry_dir, suffix=".part", delete=False) as temp_file:
+            temp_file.write(data)
+        name = self.__entry_name(validator)
+        with self.__lock:
+            # the size is kept as a running total, the cache is only scanned once it is over the limit
+            with os.scandir(entry_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.endswith(".part"):
+                        self.__size -= entry.stat().st_size
+                        if entry.name != name:
+                            os.remove(entry.path)
+            os.replace(temp_file.name, os.path.join(entry_dir, name))
+            self.__size += len(data)
+            if self.__size > self.__max_size:
+                self.__evict()
+
+        return io.BytesIO(data)
+
+    def __evict(self):
+        entries = []
+        for directory in os.scandir(self.__root):
+            if directory.is_dir():
+                # temporary files belong to puts still in flight
+                entries.extend(
+                    entry for entry in os.scandir(directory.path)
+                    if entry.is_file() and not entry.name.endswith(".part")
+                )
+
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if total <= self.__max_size:
+                break
+            logger.debug("evicting %s", entry.path)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
+            total -= entry.stat().st_size
+        self.__size = total
+
+    def _get_download_stream(self, path: str) -> io.IOBase:
+        entry_dir = self.__entry_dir(path)
+        validator = self.__validator(self._stat(path))
+
+        if validator is not None:
+            # a concurrent reader may evict the entry between the check and the open
+            with contextlib.suppress(FileNotFoundError):
+                return self.__hit(os.path.join(entry_dir, self.__entry_name(validator)))
+            stream, etag = self.__store._get_download_stream_if_changed(path, None)
+        else:
+            # the listing says nothing about the file, ask the server whether the cached copy is current
+            latest = self.__latest_entry(entry_dir)
+            etag = bytes.fromhex(latest).decode("utf-8") if latest else None
+            stream, etag = self.__store._get_download_stream_if_changed(path, etag)
+            if stream is None:
+                return self.__hit(os.path.join(entry_dir, latest))
+            validator = etag
+
+        if validator is None:
+            return stream
+        with stream:
+            return self.__put(entry_dir, validator, stream)
+
+    def _get_download_stream_if_changed(
+            self,
+            path: str,
+            etag: typing.Optional[str],
+    ) -> typing.Tuple[typing.Optional[io.IOBase], typing.Optional[str]]:
+        return self.__store._get_download_stream_if_changed(path, etag)
+
+    def _upload(self, stream: io.IOBase, path: str):
+        self.__store._upload(stream, path)
+
+    def _open_upload(self, path: str) -> typing.ContextManager[io.IOBase]:
+        return self.__store._open_upload(path)
+
+    def _replace(self, stream: io.IOBase, path: str):
+        self.__store._replace(stream, path)
+
+    def _open_replace(self, path: str) -> typing.ContextManager[io.IOBase]:
+        return self.__store._open_replace(path)
+
+    def _move(self, source: str, destination: str):
+        self.__store._move(source, destination)
+
+    def _create_folder(self, path: str):
+        self.__store._create_folder(path)
+
+    def _ls(self, path: str) -> typing.List[File]:
+        return self.__store._ls(path)
+
+    def _rm(self, path: str):
+        self.__store._rm(path)
@@ -0,0 +1,195 @@
+import io
+import typing
+import zlib
+
+from m4m_sync.utils import StreamWrapper
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class CompressStreamWrapper(StreamWrapper):
+    MAGIC = b""
+    CHUNK_SIZE = 64 * 1024
+    DEFAULT_LEVEL = None
+
+    def __init__(self, level: int = None, chunk_size: int = CHUNK_SIZE, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.level = self.DEFAULT_LEVEL if level is None else level
+        self.__chunk_size = chunk_size
+        self.__reset()
+
+    def __call__(self, *args, **kwargs):
+        result = super().__call__(*args, **kwargs)
+        self.__reset()
+        return result
+
+    def __reset(self):
+        self.__compressor = None
+        self.__decompressor = None
+        self.__read_buffer = bytearray()
+        self.__read_position = 0
+        self.__read_eof = False
+
+    def _compressor(self):
+        raise NotImplementedError
+
+    def _decompressor(self):
+        raise NotImplementedError
+
+    def _begin(self, compressor) -> bytes:
+        return b""
+
+    def _prime(self, data: bytes):
+        self.__decompressor = self._decompressor()
+        self.__read_buffer += self.__decompressor.decompress(data)
+
+    def write(self, b: typing.Union[bytes, bytearray]) -> typing.Optional[int]:
+        if self.__compressor is None:
+            self.__compressor = self._compressor()
+            header = self._begin(self.__compressor)
+            if header:
+                self._stream.write(header)
+
+        compressed = self.__compressor.compress(b)
+        if compressed:
+            self._stream.write(compressed)
+        return len(b)
+
+    def read(self, size: int = -1) -> typing.Optional[bytes]:
+        if self.__decompressor is None:
+            self._prime(b"")
+
+        while not self.__read_eof and (size < 0 or len(self.__read_buffer) - self.__read_position < size):
+            chunk = self._stream.read(self.__chunk_size)
+            if chunk:
+                self.__read_buffer += self.__decompressor.decompress(chunk)
+            else:
+                self.__read_eof = True
+
+        available = len(self.__read_buffer) - self.__read_position
+        count = available if size < 0 else min(size, available)
+        with memoryview(self.__read_buffer) as view:
+            result = bytes(view[self.__read_position:self.__read_position + count])
+        self.__read_position += count
+
+        if self.__read_position * 2 > len(self.__read_buffer):
+            del self.__read_buffer[:self.__read_position]
+            self.__read_position = 0
+
+        return result
+
+    def close(self) -> None:
+        if not self.closed and self.__compressor is not None:
+            tail = self.__compressor.flush()
+            if tail:
+                self._stream.write(tail)
+            self.__compressor = None
+        super().close()
+
+
+class GzipStreamWrapper(CompressStreamWrapper):
+    MAGIC = b"\x1f\x8b"
+    DEFAULT_LEVEL = 6
+
+    def _compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def _decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class ZstdStreamWrapper(CompressStreamWrapper):
+    MAGIC = b"\x28\xb5\x2f\xfd"
+    DEFAULT_LEVEL = 3
+
+    def __init__(self, *args, **kwargs):
+        if zstandard is None:
+            raise ImportError("zstd compression requires the 'zstandard' package")
+        super().__init__(*args, **kwargs)
+
+    def _compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def _decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class Lz4StreamWrapper(CompressStreamWrapper):
+    MAGIC = b"\x04\x22\x4d\x18"
+    DEFAULT_LEVEL = 0
+
+    def __init__(self, *args, **kwargs):
+        if lz4 is None:
+            raise ImportError("lz4 compression requires the 'lz4' package")
+        super().__init__(*args, **kwargs)
+
+    def _compressor(self):
+        return lz4.frame.LZ4FrameCompressor(compression_level=self.level)
+
+    def _begin(self, compressor) -> bytes:
+        return compressor.begin()
+
+    def _decompressor(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+COMPRESSORS = {
+    "gzip": GzipStreamWrapper,
+    "zstd": ZstdStreamWrapper,
+    "lz4": Lz4StreamWrapper,
+}
+
+
+class AutoDecompressStreamWrapper(StreamWrapper):
+    __SNIFF_SIZE = 4
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__delegate = None
+
+    def __call__(self, *args, **kwargs):
+        result = super().__call__(*args, **kwargs)
+        self.__delegate = None
+        return result
+
+    def __detect(self) -> io.IOBase:
+        head = self._stream.read(self.__SNIFF_SIZE) or b""
+        for wrapper in COMPRESSORS.values():
+            if head.startswith(wrapper.MAGIC):
+                delegate = wrapper()(self._stream)
+                delegate._prime(head)
+                return delegate
+        return _PrefixedStream(head, self._stream)
+
+    def read(self, size: int = -1) -> typing.Optional[bytes]:
+        if self.__delegate is None:
+            self.__delegate = self.__detect()
+        return self.__delegate.read(size)
+
+
+class _PrefixedStream:
+    def __init__(self, prefix: bytes, stream: io.IOBase):
+        self.__prefix = prefix
+        self.__stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if not self.__prefix:
+            return self.__stream.read(size)
+
+        if size < 0:
+            result = self.__prefix + (self.__stream.read() or b"")
+            self.__prefix = b""
+            return result
+
+        result, self.__prefix = self.__prefix[:size], self.__prefix[size:]
+        if len(result) < size:
+            result += self.__stream.read(size - len(result)) or b""
+        return result
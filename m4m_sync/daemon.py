@@ -0,0 +1,217 @@
+import http.server
+import json
+import logging
+import random
+import signal
+import threading
+import time
+import typing
+
+from m4m_sync.metrics import registry
+from m4m_sync.scheduler import SyncScheduler
+from m4m_sync.stores import Sensor
+from m4m_sync.utils import DateTimeRange
+
+logger = logging.getLogger(__name__)
+
+
+class SyncDaemon:
+    RETRY_INTERVAL = 300
+
+    def __init__(
+            self,
+            scheduler: SyncScheduler,
+            load_sensors: typing.Callable[[], typing.Tuple[typing.List[Sensor], dict]],
+            serializer_factory,
+            stream_wrapper_factory,
+            interval: float = 86400,
+            sensor_intervals: typing.Dict[str, float] = None,
+            jitter: float = 0.1,
+            plan_interval: float = 3600,
+            full_interval: float = 86400,
+            verify: bool = False,
+            after_run: typing.Callable[[], None] = None,
+    ):
+        self.__scheduler = scheduler
+        self.__load_sensors = load_sensors
+        self.__serializer_factory = serializer_factory
+        self.__stream_wrapper_factory = stream_wrapper_factory
+        self.__interval = interval
+        self.__sensor_intervals = sensor_intervals or {}
+        self.__jitter = jitter
+        self.__plan_interval = plan_interval
+        self.__full_interval = full_interval
+        self.__verify = verify
+        self.__after_run = after_run
+
+        self.__stop = threading.Event()
+        self.__lock = threading.Lock()
+        self.__state = "starting"
+        self.__started = time.time()
+        self.__sensors = {}
+        self.__due = {}
+        self.__full_due = {}
+        self.__failing = {}
+        self.__watermarks = {}
+        self.__plan_due = 0.
+        self.__last_run = None
+        self.__server = None
+
+    def stop(self):
+        self.__stop.set()
+
+    def __next_due(self, sensor: Sensor, now: float, failed: bool = False) -> float:
+        interval = self.__sensor_intervals.get(sensor.id, self.__interval)
+        if failed:
+            interval = min(interval, self.RETRY_INTERVAL)
+        # spreads sensors with the same interval over time instead of syncing them in one burst
+        return now + interval * (1 + random.uniform(-self.__jitter, self.__jitter))
+
+    def __load_plan(self, now: float):
+        sensors, watermarks = self.__load_sensors()
+        with self.__lock:
+            # known sensors keep their schedule, new ones are due right away
+            self.__due = {sensor.id: self.__due.get(sensor.id, now) for sensor in sensors}
+            self.__full_due = {sensor.id: self.__full_due.get(sensor.id, now) for sensor in sensors}
+            self.__failing = {sensor.id: self.__failing[sensor.id] for sensor in sensors if sensor.id in self.__failing}
+            self.__sensors = {sensor.id: sensor for sensor in sensors}
+        # the plan's watermarks are only current for the run right after it was loaded
+        self.__watermarks = watermarks
+        logger.info("loaded %d sensor(s)", len(sensors))
+
+    def __run_due(self, now: float):
+        due = [self.__sensors[sensor_id] for sensor_id, at in self.__due.items() if at <= now]
+        if not due:
+            return
+
+        # fingerprinting a sensor's whole history is left to the full passes, the runs in between only look at
+        # recent partitions; yesterday is included for rows that arrive around midnight, as in SyncScheduler.watch
+        recent = DateTimeRange.day(-1).start
+        sinces = {sensor.id: recent for sensor in due if self.__full_due.get(sensor.id, now) > now}
+
+        started = time.time()
+        self.__state = "running"
+        failed = self.__scheduler.run(
+            sensors=due,
+            serializer_factory=self.__serializer_factory,
+            stream_wrapper_factory=self.__stream_wrapper_factory,
+            verify=self.__verify,
+            watermarks=self.__watermarks,
+            stop=self.__stop,
+            sinces=sinces,
+        )
+        self.__watermarks = {}
+        self.__state = "idle"
+
+        failed_ids = {sensor.id for sensor in failed}
+        finished = time.monotonic()
+        with self.__lock:
+            for sensor in due:
+                if sensor.id not in self.__due:
+                    continue
+                self.__due[sensor.id] = self.__next_due(sensor, finished, failed=sensor.id in failed_ids)
+                self.__failing[sensor.id] = sensor.id in failed_ids
+                if sensor.id not in sinces and sensor.id not in failed_ids:
+                    self.__full_due[sensor.id] = finished + self.__full_interval
+            self.__last_run = {
+                "started": started,
+                "duration_seconds": time.time() - started,
+                "sensors": len(due),
+                "failed": sorted(failed_ids),
+            }
+
+        registry.set("daemon_last_run_duration_seconds", self.__last_run["duration_seconds"])
+        registry.set("daemon_last_run_failed_sensors", len(failed_ids))
+        if failed:
+            logger.warning("failed to sync %d of %d sensor(s)", len(failed), len(due))
+        if self.__after_run is not None:
+            self.__after_run()
+        # counters stay cumulative, the per-partition records would otherwise pile up for the daemon's lifetime
+        registry.reset_partitions()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda *_: self.__stop.set())
+
+        # one pool for the whole lifetime keeps the workers' stores, HTTP sessions and listings warm
+        with self.__scheduler:
+            while not self.__stop.is_set():
+                now = time.monotonic()
+                if now >= self.__plan_due:
+                    try:
+                        self.__load_plan(now)
+                        self.__plan_due = now + self.__plan_interval
+                    except Exception:
+                        logger.exception("Failed to load the sync plan")
+                        self.__plan_due = now + self.RETRY_INTERVAL
+
+                self.__run_due(now)
+
+                wake_up = min(min(self.__due.values(), default=self.__plan_due), self.__plan_due)
+                self.__stop.wait(max(wake_up - time.monotonic(), 1))
+
+        self.__state = "stopped"
+        logger.info("stopped")
+        if self.__server is not None:
+            self.__server.shutdown()
+
+    def status(self) -> dict:
+        with self.__lock:
+            last_run = dict(self.__last_run) if self.__last_run else None
+            next_due = min(self.__due.values(), default=None)
+            sensors = len(self.__sensors)
+            # the latest result of every known sensor, a batch may be a single sensor being retried
+            failing = sorted(sensor_id for sensor_id, failed in self.__failing.items() if failed)
+            synced = len(self.__failing)
+
+        if self.__stop.is_set():
+            status = "stopping"
+        elif not synced:
+            status = "starting"
+        elif len(failing) == synced:
+            status = "failing"
+        elif failing:
+            status = "degraded"
+        else:
+            status = "ok"
+
+        return {
+            "status": status,
+            "state": self.__state,
+            "uptime_seconds": time.time() - self.__started,
+            "sensors": sensors,
+            "failing_sensors": failing,
+            "next_run_in_seconds": max(next_due - time.monotonic(), 0) if next_due is not None else None,
+            "last_run": last_run,
+        }
+
+    def serve_health(self, host: str, port: int) -> http.server.HTTPServer:
+        daemon = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/health":
+                    status = daemon.status()
+                    code = 503 if status["status"] in ("failing", "stopping") else 200
+                    self.__respond(code, "application/json", json.dumps(status).encode("utf-8"))
+                elif self.path == "/metrics":
+                    self.__respond(200, "text/plain; version=0.0.4", registry.prometheus().encode("utf-8"))
+                else:
+                    self.__respond(404, "text/plain", b"not found\n")
+
+            def __respond(self, code: int, content_type: str, body: bytes):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("%s " + format, self.address_string(), *args)
+
+        self.__server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, name="health", daemon=True).start()
+        logger.info("serving health on %s:%d", host, port)
+        return self.__server
@@ -1,81 +1,512 @@
+import collections
 import hashlib
+import io
 import os
+import struct
+import threading
 import typing
 
 from Crypto import Random
 from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF, scrypt
 
+from m4m_sync.metrics import registry
 from m4m_sync.utils import StreamWrapper
 
 
+def read_exact(stream: io.IOBase, size: int) -> bytes:
+    result = stream.read(size)
+    if not result or len(result) == size:
+        return result or b""
+
+    result = bytearray(result)
+    while len(result) < size:
+        chunk = stream.read(size - len(result))
+        if not chunk:
+            break
+        result += chunk
+    return bytes(result)
+
+
+class KeyManager:
+    KDF_SHA256 = 1
+    KDF_HKDF = 2
+    KDF_SCRYPT = 3
+    KDFS = {"sha256": KDF_SHA256, "hkdf": KDF_HKDF, "scrypt": KDF_SCRYPT}
+    SALT_SIZE = 16
+
+    # log2(N), r, p, salt
+    __SCRYPT_PARAMS = struct.Struct(">BII16s")
+
+    def __init__(
+            self,
+            secret: typing.Union[str, bytes, typing.Callable[[], typing.Union[str, bytes]]],
+            kdf: int = KDF_HKDF,
+            cache_size: int = 128,
+            scrypt_log_n: int = 14,
+            scrypt_r: int = 8,
+            scrypt_p: int = 1,
+    ):
+        if kdf not in (self.KDF_SHA256, self.KDF_HKDF, self.KDF_SCRYPT):
+            raise ValueError("unknown key derivation: {}".format(kdf))
+
+        self.kdf = kdf
+        self.__secret = secret
+        self.__cache_size = cache_size
+        self.__scrypt = (scrypt_log_n, scrypt_r, scrypt_p)
+        self.__init_state()
+
+    def __init_state(self):
+        self.__lock = threading.Lock()
+        self.__salts = {}
+        self.__keys = collections.OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("lock", "salts", "keys"):
+            del state["_KeyManager__" + name]
+        state["_KeyManager__secret"] = self.secret()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__init_state()
+
+    def secret(self) -> bytes:
+        if callable(self.__secret):
+            self.__secret = self.__secret()
+        if isinstance(self.__secret, str):
+            self.__secret = self.__secret.encode('utf-8')
+        return self.__secret
+
+    def params(self, context: str = None) -> bytes:
+        if self.kdf == self.KDF_SHA256:
+            return b""
+
+        context = (context or "").encode('utf-8')
+        with self.__lock:
+            salt = self.__salts.get(context)
+            if salt is None:
+                salt = self.__salts[context] = Random.new().read(self.SALT_SIZE)
+
+        if self.kdf == self.KDF_SCRYPT:
+            return self.__SCRYPT_PARAMS.pack(*self.__scrypt, salt) + context
+        return salt + context
+
+    def derive(self, kdf: int, params: bytes) -> bytes:
+        cache_key = (kdf, params)
+        with self.__lock:
+            key = self.__keys.get(cache_key)
+            if key is not None:
+                self.__keys.move_to_end(cache_key)
+                return key
+
+        key = self.__derive(kdf, params)
+
+        with self.__lock:
+            self.__keys[cache_key] = key
+            while len(self.__keys) > self.__cache_size:
+                self.__keys.popitem(last=False)
+        return key
+
+    def __derive(self, kdf: int, params: bytes) -> bytes:
+        if kdf == self.KDF_SHA256:
+            return hashlib.sha256(self.secret()).digest()
+        if kdf == self.KDF_HKDF:
+            salt, context = params[:self.SALT_SIZE], params[self.SALT_SIZE:]
+            return HKDF(self.secret(), 32, salt, SHA256, context=context)
+        if kdf == self.KDF_SCRYPT:
+            log_n, r, p, salt = self.__SCRYPT_PARAMS.unpack_from(params)
+            context = params[self.__SCRYPT_PARAMS.size:]
+            return scrypt(self.secret(), salt + context, 32, N=2 ** log_n, r=r, p=p)
+        raise ValueError("unsupported key derivation: {}".format(kdf))
+
+
+class AesGcmStreamWrapper(StreamWrapper):
+    MAGIC = b"\x89M4M\r\n\x1a\n"
+    VERSION = 1
+    CIPHER_AES_GCM = 1
+    CHUNK_SIZE = 64 * 1024
+    TAG_SIZE = 16
+
+    # magic, version, cipher, kdf, chunk size, nonce prefix, kdf params length
+    __HEADER = struct.Struct(">8sBBBI8sH")
+    __CHUNK_AAD = struct.Struct(">I?")
+
+    def __init__(
+            self,
+            key: typing.Union[str, bytes, KeyManager],
+            chunk_size: int = CHUNK_SIZE,
+            context: str = None,
+            *args,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+
+        self.__keys = key if isinstance(key, KeyManager) else KeyManager(key)
+        self.__context = context
+        self.__chunk_size = chunk_size
+        self.__reset()
+
+    def __call__(self, *args, **kwargs):
+        result = super().__call__(*args, **kwargs)
+        self.__reset()
+        return result
+
+    def __reset(self):
+        self.__header = None
+        self.__key = None
+        self.__nonce_prefix = None
+        self.__record_size = None
+        self.__data_offset = None
+        self.__index = 0
+        self.__write_buffer = None
+        self.__read_buffer = bytearray()
+        self.__read_position = 0
+        self.__next_record = None
+        self.__read_eof = False
+
+    def __write_header(self):
+        self.__nonce_prefix = Random.new().read(8)
+        kdf_params = self.__keys.params(self.__context)
+        self.__header = self.__HEADER.pack(
+            self.MAGIC,
+            self.VERSION,
+            self.CIPHER_AES_GCM,
+            self.__keys.kdf,
+            self.__chunk_size,
+            self.__nonce_prefix,
+            len(kdf_params),
+        ) + kdf_params
+        self.__key = self.__keys.derive(self.__keys.kdf, kdf_params)
+        self.__record_size = self.__chunk_size + self.TAG_SIZE
+        self._stream.write(self.__header)
+
+    def _read_header(self, prefix: bytes = b""):
+        fixed = prefix + read_exact(self._stream, self.__HEADER.size - len(prefix))
+        if len(fixed) < self.__HEADER.size:
+            raise ValueError("truncated header")
+
+        magic, version, cipher, kdf, chunk_size, nonce_prefix, kdf_params_size = self.__HEADER.unpack(fixed)
+        if magic != self.MAGIC:
+            raise ValueError("not an encrypted container")
+        if version != self.VERSION or cipher != self.CIPHER_AES_GCM:
+            raise ValueError("unsupported container version {} / cipher {}".format(version, cipher))
+
+        kdf_params = read_exact(self._stream, kdf_params_size)
+        self.__header = fixed + kdf_params
+        self.__key = self.__keys.derive(kdf, kdf_params)
+        self.__nonce_prefix = nonce_prefix
+        self.__record_size = chunk_size + self.TAG_SIZE
+        self.__data_offset = len(self.__header)
+
+    def __cipher(self, index: int, final: bool):
+        cipher = AES.new(self.__key, AES.MODE_GCM, nonce=self.__nonce_prefix + struct.pack(">I", index))
+        cipher.update(self.__header + self.__CHUNK_AAD.pack(index, final))
+        return cipher
+
+    def __encrypt_chunk(self, data: typing.Union[bytes, memoryview], final: bool):
+        with registry.timer("encrypt", mode="gcm"):
+            ciphertext, tag = self.__cipher(self.__index, final).encrypt_and_digest(data)
+        registry.inc("cipher_bytes_total", len(data), operation="encrypt", mode="gcm")
+        self._stream.write(ciphertext)
+        self._stream.write(tag)
+        self.__index += 1
+
+    def decrypt_chunk(self, index: int, record: bytes, final: bool) -> bytes:
+        if len(record) < self.TAG_SIZE:
+            raise ValueError("truncated chunk {}".format(index))
+        try:
+            with registry.timer("decrypt", mode="gcm"):
+                data = self.__cipher(index, final).decrypt_and_verify(record[:-self.TAG_SIZE], record[-self.TAG_SIZE:])
+        except ValueError:
+            raise ValueError("chunk {} is corrupted or truncated".format(index))
+        registry.inc("cipher_bytes_total", len(data), operation="decrypt", mode="gcm")
+        return data
+
+    def write(self, b: typing.Union[bytes, bytearray]) -> typing.Optional[int]:
+        if self.__header is None:
+            self.__write_header()
+        if self.__write_buffer is None:
+            self.__write_buffer = bytearray()
+
+        self.__write_buffer += b
+        # the last chunk is written on close, so a full buffer is only flushed once more data arrives
+        if len(self.__write_buffer) > self.__chunk_size:
+            count = (len(self.__write_buffer) - 1) // self.__chunk_size * self.__chunk_size
+            with memoryview(self.__write_buffer) as buffer:
+                for offset in range(0, count, self.__chunk_size):
+                    self.__encrypt_chunk(buffer[offset:offset + self.__chunk_size], final=False)
+            del self.__write_buffer[:count]
+
+        return len(b)
+
+    def close(self) -> None:
+        if not self.closed and self.__write_buffer is not None:
+            self.__encrypt_chunk(bytes(self.__write_buffer), final=True)
+            self.__write_buffer = None
+        super().close()
+
+    def __ensure_header(self):
+        if self.__header is None:
+            self._read_header()
+
+    def __fill_read_buffer(self):
+        if self.__next_record is None:
+            self.__next_record = read_exact(self._stream, self.__record_size)
+
+        record = self.__next_record
+        self.__next_record = read_exact(self._stream, self.__record_size)
+        final = not self.__next_record
+
+        self.__read_buffer += self.decrypt_chunk(self.__index, record, final)
+        self.__index += 1
+        self.__read_eof = final
+
+    def __available(self) -> int:
+        return len(self.__read_buffer) - self.__read_position
+
+    def read(self, size: int = -1) -> typing.Optional[bytes]:
+        self.__ensure_header()
+
+        while not self.__read_eof and (size < 0 or self.__available() < size):
+            self.__fill_read_buffer()
+
+        count = self.__available() if size < 0 else min(size, self.__available())
+        with memoryview(self.__read_buffer) as view:
+            result = bytes(view[self.__read_position:self.__read_position + count])
+        self.__read_position += count
+
+        if self.__read_position * 2 > len(self.__read_buffer):
+            del self.__read_buffer[:self.__read_position]
+            self.__read_position = 0
+
+        return result
+
+    def chunk_count(self) -> int:
+        self.__ensure_header()
+        size = self._stream.seek(0, os.SEEK_END) - self.__data_offset
+        return max(1, -(-size // self.__record_size))
+
+    def read_chunk(self, index: int) -> bytes:
+        count = self.chunk_count()
+        if not 0 <= index < count:
+            raise IndexError("chunk {} out of range".format(index))
+
+        self._stream.seek(self.__data_offset + index * self.__record_size)
+        return self.decrypt_chunk(index, read_exact(self._stream, self.__record_size), final=index == count - 1)
+
+    def iter_chunks(self, executor=None, read_ahead: int = 8) -> typing.Iterator[bytes]:
+        self.__ensure_header()
+
+        pending = collections.deque()
+        record = read_exact(self._stream, self.__record_size)
+        index = 0
+        while True:
+            next_record = read_exact(self._stream, self.__record_size)
+            final = not next_record
+
+            if executor is None:
+                yield self.decrypt_chunk(index, record, final)
+            else:
+                pending.append(executor.submit(self.decrypt_chunk, index, record, final))
+                if len(pending) >= read_ahead:
+                    yield pending.popleft().result()
+
+            if final:
+                break
+            record = next_record
+            index += 1
+
+        while pending:
+            yield pending.popleft().result()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if self.__write_buffer is not None:
+            return super().seek(offset, whence)
+        if whence != os.SEEK_SET:
+            raise io.UnsupportedOperation("only absolute seeks are supported")
+
+        self.__ensure_header()
+        chunk_size = self.__record_size - self.TAG_SIZE
+        count = self.chunk_count()
+        # the last chunk is never empty unless the whole stream is, offsets at or past the end land after it
+        index = min(offset // chunk_size, count - 1)
+        chunk = self.read_chunk(index)
+
+        self.__read_buffer = bytearray(chunk)
+        self.__read_position = min(offset - index * chunk_size, len(chunk))
+        self.__index = index + 1
+        self.__next_record = None
+        self.__read_eof = index == count - 1
+        self._stream.seek(self.__data_offset + self.__index * self.__record_size)
+        return offset
+
+
 class AesStreamWrapper(StreamWrapper):
-    def __init__(self, key: typing.Union[str, bytes], *args, **kwargs):
+    CHUNK_SIZE = 64 * 1024
+    MODE_CBC = "cbc"
+    MODE_GCM = "gcm"
+
+    def __init__(
+            self,
+            key: typing.Union[str, bytes, KeyManager],
+            chunk_size: int = CHUNK_SIZE,
+            mode: str = MODE_CBC,
+            context: str = None,
+            *args,
+            **kwargs
+    ):
         super().__init__(*args, **kwargs)
 
-        if isinstance(key, str):
-            key = key.encode('utf-8')
+        if mode not in (self.MODE_CBC, self.MODE_GCM):
+            raise ValueError("unknown mode: {}".format(mode))
 
         self.__block_size = AES.block_size
-        self.__key = hashlib.sha256(key).digest()
+        self.__chunk_size = chunk_size - chunk_size % self.__block_size or self.__block_size
+        self.__mode = mode
+        self.__context = context
+        self.__keys = key if isinstance(key, KeyManager) else KeyManager(key)
         self.__cipher = None
-        self.__write_buffer = bytearray()
-        self.__read_buffer = False
+        self.__delegate = None
+        self.__write_buffer = None
+        self.__reset_read_state()
 
     def __call__(self, *args, **kwargs):
         result = super().__call__(*args, **kwargs)
         self.__cipher = None
+        self.__delegate = None
         self.__write_buffer = None
-        self.__read_buffer = False
+        self.__reset_read_state()
         return result
 
+    def __create_delegate(self) -> AesGcmStreamWrapper:
+        self.__delegate = AesGcmStreamWrapper(
+            key=self.__keys,
+            chunk_size=self.__chunk_size,
+            context=self.__context,
+        )(self._stream)
+        return self.__delegate
+
+    def __reset_read_state(self):
+        self.__read_buffer = bytearray()
+        self.__read_position = 0
+        self.__read_tail = b""
+        self.__read_eof = False
+
+    def __fill_read_buffer(self):
+        chunk = self._stream.read(self.__chunk_size)
+
+        if not chunk:
+            self.__read_eof = True
+            if self.__read_tail:
+                self.__read_buffer += self.__unpad(self.__decrypt(self.__read_tail))
+                self.__read_tail = b""
+            return
+
+        data = self.__read_tail + chunk if self.__read_tail else chunk
+        # keep the last complete block back until EOF, it holds the padding
+        decryptable = (len(data) // self.__block_size - 1) * self.__block_size
+        if decryptable > 0:
+            with memoryview(data) as view:
+                self.__read_buffer += self.__decrypt(view[:decryptable])
+            self.__read_tail = data[decryptable:]
+        else:
+            self.__read_tail = data
+
+    def __decrypt(self, data: typing.Union[bytes, memoryview]) -> bytes:
+        with registry.timer("decrypt", mode="cbc"):
+            data = self.__cipher.decrypt(data)
+        registry.inc("cipher_bytes_total", len(data), operation="decrypt", mode="cbc")
+        return data
+
+    def __available(self) -> int:
+        return len(self.__read_buffer) - self.__read_position
+
     def read(self, size: int = -1) -> typing.Optional[bytes]:
+        if self.__delegate is not None:
+            return self.__delegate.read(size)
+
         if self.__cipher is None:
-            iv = self._stream.read(self.__block_size)
-            self.__cipher = AES.new(self.__key, AES.MODE_CBC, iv)
-
-        if self.__read_buffer == False:
-            self.__read_buffer = self.__unpad(self.__cipher.decrypt(self._stream.read()))
-        if size == -1:
-            result = self.__read_buffer
-            self.__read_buffer = None
-            return result
-        else:
-            result = self.__read_buffer[:size]
-            self.__read_buffer = self.__read_buffer[size:]
-            return result
+            iv = read_exact(self._stream, self.__block_size)
+            if iv.startswith(AesGcmStreamWrapper.MAGIC):
+                self.__create_delegate()._read_header(iv)
+                return self.__delegate.read(size)
+            self.__cipher = AES.new(self.__keys.derive(KeyManager.KDF_SHA256, b""), AES.MODE_CBC, iv)
+
+        while not self.__read_eof and (size < 0 or self.__available() < size):
+            self.__fill_read_buffer()
+
+        count = self.__available() if size < 0 else min(size, self.__available())
+        with memoryview(self.__read_buffer) as view:
+            result = bytes(view[self.__read_position:self.__read_position + count])
+        self.__read_position += count
+
+        # compact consumed plaintext once it dominates the buffer, amortized O(1) per byte
+        if self.__read_position > self.__chunk_size and self.__read_position * 2 > len(self.__read_buffer):
+            del self.__read_buffer[:self.__read_position]
+            self.__read_position = 0
+
+        return result
 
     def write(self, b: typing.Union[bytes, bytearray]) -> typing.Optional[int]:
+        if self.__mode == self.MODE_GCM:
+            return (self.__delegate or self.__create_delegate()).write(b)
+
         if self.__cipher is None:
             iv = Random.new().read(self.__block_size)
-            self.__cipher = AES.new(self.__key, AES.MODE_CBC, iv)
+            self.__cipher = AES.new(self.__keys.derive(KeyManager.KDF_SHA256, b""), AES.MODE_CBC, iv)
             self._stream.write(iv)
 
         if self.__write_buffer is None:
-            self.__write_buffer = bytearray()
+            self.__write_buffer = bytearray(self.__chunk_size)
+            self.__write_output = bytearray(self.__chunk_size)
+            self.__write_length = 0
 
-        # full the buffer and encrypt it if possible
-        move_to_buffer_count = self.__block_size - len(self.__write_buffer)
-        self.__write_buffer += b[:move_to_buffer_count]
-        if len(self.__write_buffer) % self.__block_size == 0:
-            self._stream.write(self.__cipher.encrypt(self.__write_buffer))
-            self.__write_buffer = bytearray()
-        b = b[move_to_buffer_count:]
+        with memoryview(b) as data, memoryview(self.__write_buffer) as buffer:
+            total = data.nbytes
+            offset = 0
 
-        # encrypt remaining part (with no tail)
-        to_write_count = (len(b) // self.__block_size) * self.__block_size
-        self._stream.write(self.__cipher.encrypt(b[:to_write_count]))
-        b = b[to_write_count:]
+            # large writes bypass the staging buffer when it is empty
+            if self.__write_length == 0:
+                while total - offset >= self.__chunk_size:
+                    self.__encrypt(data[offset:offset + self.__chunk_size])
+                    offset += self.__chunk_size
 
-        # buffer the tail
-        self.__write_buffer += b
+            while offset < total:
+                count = min(self.__chunk_size - self.__write_length, total - offset)
+                buffer[self.__write_length:self.__write_length + count] = data[offset:offset + count]
+                self.__write_length += count
+                offset += count
+
+                if self.__write_length == self.__chunk_size:
+                    self.__encrypt(buffer)
+                    self.__write_length = 0
+
+        return total
+
+    def __encrypt(self, data: memoryview):
+        with memoryview(self.__write_output) as output:
+            output = output[:len(data)]
+            with registry.timer("encrypt", mode="cbc"):
+                self.__cipher.encrypt(data, output=output)
+            registry.inc("cipher_bytes_total", len(data), operation="encrypt", mode="cbc")
+            self._stream.write(output)
 
     def close(self) -> None:
-        if self.writable() and self.__write_buffer is not None:
-            self.seek(0, os.SEEK_END)
+        if self.__delegate is not None:
+            self.__delegate.close()
 
-            to_pad = self.__block_size - len(self.__write_buffer) % self.__block_size
-            self._stream.write(self.__cipher.encrypt(self.__write_buffer + bytearray([to_pad] * to_pad)))
-            self.__write_buffer = bytearray()
+        if not self.closed and self.writable() and self.__write_buffer is not None:
+            if self._stream.seekable():
+                self.seek(0, os.SEEK_END)
+
+            to_pad = self.__block_size - self.__write_length % self.__block_size
+            self.__write_buffer[self.__write_length:self.__write_length + to_pad] = bytes([to_pad] * to_pad)
+            with memoryview(self.__write_buffer) as buffer:
+                self.__encrypt(buffer[:self.__write_length + to_pad])
+            self.__write_buffer = None
         super().close()
 
     @staticmethod
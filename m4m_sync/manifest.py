@@ -0,0 +1,65 @@
+import datetime
+import json
+import typing
+
+
+class SyncManifest:
+    NAME = "manifest.json"
+    VERSION = 3
+    FINGERPRINT = ("count", "max_id", "checksum")
+
+    def __init__(self, watermark: datetime.datetime = None, count: int = 0, partitions: typing.Dict[str, dict] = None):
+        self.watermark = watermark
+        self.count = count
+        self.partitions = partitions or {}
+        # only a manifest that changed since it was loaded needs to be written back
+        self.dirty = False
+
+    # partitions are keyed by their file name, which also carries the granularity
+    def get(self, name: str) -> typing.Optional[dict]:
+        return self.partitions.get(name)
+
+    def set(self, name: str, fingerprint: typing.Sequence, digest: typing.Optional[str]):
+        self.partitions[name] = dict(zip(self.FINGERPRINT, fingerprint), sha256=digest)
+        self.dirty = True
+
+    def remove(self, name: str):
+        if self.partitions.pop(name, None) is not None:
+            self.dirty = True
+
+    def set_watermark(self, watermark: typing.Optional[datetime.datetime], count: int):
+        if not self.is_current(watermark, count):
+            self.watermark, self.count = watermark, count
+            self.dirty = True
+
+    def is_current(self, watermark: typing.Optional[datetime.datetime], count: int) -> bool:
+        return self.watermark == watermark and self.count == count
+
+    def is_changed(self, name: str, fingerprint: typing.Sequence) -> bool:
+        entry = self.get(name) or {}
+        stored = tuple(entry.get(field) for field in self.FINGERPRINT)
+        if None in (stored[-1], fingerprint[-1]):
+            # the checksum is left out for partitions older than the watermark, count and max id still apply
+            return stored[:-1] != tuple(fingerprint[:-1])
+        return stored != tuple(fingerprint)
+
+    def dumps(self) -> bytes:
+        return json.dumps({
+            "version": self.VERSION,
+            "watermark": self.watermark.isoformat() if self.watermark else None,
+            "count": self.count,
+            "partitions": self.partitions,
+        }, sort_keys=True).encode("utf-8")
+
+    @classmethod
+    def loads(cls, data: bytes) -> "SyncManifest":
+        manifest = json.loads(data.decode("utf-8"))
+        if manifest.get("version") != cls.VERSION:
+            raise ValueError("unsupported manifest version: {}".format(manifest.get("version")))
+
+        watermark = manifest.get("watermark")
+        return cls(
+            watermark=datetime.datetime.fromisoformat(watermark) if watermark else None,
+            count=manifest.get("count", 0),
+            partitions=manifest.get("partitions"),
+        )
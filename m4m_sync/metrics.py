@@ -0,0 +1,193 @@
+import collections
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import typing
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    PREFIX = "m4m_sync"
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__started = datetime.datetime.now()
+        self.__values = collections.OrderedDict()
+        self.__partitions = []
+
+    @staticmethod
+    def __key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self.__key(name, labels)
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.__lock:
+            self.__values[self.__key(name, labels)] = value
+
+    def __add_timing(self, name: str, seconds: float, labels: dict):
+        seconds_key, calls_key = self.__key(name + "_seconds_total", labels), self.__key(name + "_total", labels)
+        with self.__lock:
+            self.__values[seconds_key] = self.__values.get(seconds_key, 0) + seconds
+            self.__values[calls_key] = self.__values.get(calls_key, 0) + 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.__add_timing(name, time.perf_counter() - started, labels)
+
+    def timed(self, name: str, **labels):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def timed_iter(self, iterable: typing.Iterable, name: str, **labels) -> typing.Iterator:
+        # only the time spent producing items is counted, and added once so per-row iteration stays lock free
+        elapsed = 0.
+        iterator = iter(iterable)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield item
+        finally:
+            self.__add_timing(name, elapsed, labels)
+
+    def add_partition(self, sensor: str, partition: str, rows: int, size: int, seconds: float):
+        # per sensor detail only goes to the json partitions list, a sensor label is a series per sensor in prometheus
+        self.inc("rows_total", rows)
+        self.inc("partitions_total")
+        self.inc("partition_bytes_total", size)
+        self.inc("store_bytes_total", size, direction="out")
+        with self.__lock:
+            self.__partitions.append({
+                "sensor": sensor,
+                "partition": partition,
+                "rows": rows,
+                "bytes": size,
+                "seconds": seconds,
+            })
+
+    def reset_partitions(self) -> list:
+        with self.__lock:
+            partitions, self.__partitions = self.__partitions, []
+        return partitions
+
+    def snapshot(self, reset: bool = False) -> dict:
+        with self.__lock:
+            snapshot = {
+                "values": [[name, dict(labels), value] for (name, labels), value in self.__values.items()],
+                "partitions": list(self.__partitions),
+            }
+            if reset:
+                self.__values = collections.OrderedDict()
+                self.__partitions = []
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        for name, labels, value in snapshot["values"]:
+            self.inc(name, value, **labels)
+        with self.__lock:
+            self.__partitions.extend(snapshot["partitions"])
+
+    def summary(self) -> dict:
+        snapshot = self.snapshot()
+
+        phases = collections.OrderedDict()
+        for name, _, value in snapshot["values"]:
+            if name.endswith("_seconds_total"):
+                phase = phases.setdefault(name[:-len("_seconds_total")], {"seconds": 0, "calls": 0})
+                phase["seconds"] += value
+        for name, _, value in snapshot["values"]:
+            if name.endswith("_total") and name[:-len("_total")] in phases:
+                phases[name[:-len("_total")]]["calls"] += value
+
+        return {
+            "started": self.__started.isoformat(),
+            "duration_seconds": (datetime.datetime.now() - self.__started).total_seconds(),
+            "phases": phases,
+            "metrics": [{"name": name, "labels": labels, "value": value} for name, labels, value in snapshot["values"]],
+            "partitions": snapshot["partitions"],
+        }
+
+    def dumps(self) -> bytes:
+        return json.dumps(self.summary(), indent=2, sort_keys=True).encode("utf-8")
+
+    @staticmethod
+    def __escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def prometheus(self) -> str:
+        families = collections.OrderedDict()
+        for name, labels, value in self.snapshot()["values"]:
+            families.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, samples in families.items():
+            full_name = "{}_{}".format(self.PREFIX, name)
+            lines.append("# TYPE {} {}".format(full_name, "counter" if name.endswith("_total") else "gauge"))
+            for labels, value in samples:
+                labels = ",".join('{}="{}"'.format(key, self.__escape(labels[key])) for key in sorted(labels))
+                lines.append("{}{} {!r}".format(full_name, "{" + labels + "}" if labels else "", float(value)))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: str):
+        self.__write_atomic(path, self.dumps())
+
+    def write_textfile(self, path: str):
+        # node_exporter may read the directory at any moment, it must never see a half written file
+        self.__write_atomic(path, self.prometheus().encode("utf-8"))
+
+    @staticmethod
+    def __write_atomic(path: str, data: bytes):
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp", delete=False) as f:
+            f.write(data)
+        # temporary files are private, node_exporter usually runs as another user
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+
+    def push(self, gateway: str, job: str = PREFIX):
+        response = requests.put(
+            "{}/metrics/job/{}".format(gateway.rstrip("/"), job),
+            data=self.prometheus().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4"},
+        )
+        response.raise_for_status()
+
+    def export(self, json_path: str = None, textfile: str = None, pushgateway: str = None):
+        if json_path:
+            self.write_json(json_path)
+        if textfile:
+            self.write_textfile(textfile)
+        if pushgateway:
+            try:
+                self.push(pushgateway)
+            except requests.RequestException:
+                logger.exception("Failed to push metrics to %s", pushgateway)
+
+
+registry = Metrics()
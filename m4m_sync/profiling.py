@@ -0,0 +1,127 @@
+import contextlib
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+import typing
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    def __init__(
+            self,
+            output_dir: str,
+            profile: bool = True,
+            trace_memory: bool = False,
+            min_seconds: float = None,
+            min_bytes: int = None,
+            top: int = 30,
+            frames: int = 10,
+    ):
+        self.output_dir = output_dir
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.min_seconds = min_seconds
+        self.min_bytes = min_bytes
+        self.top = top
+        self.frames = frames
+
+    def __is_interesting(self, seconds: float, size: typing.Optional[int]) -> bool:
+        if self.min_seconds is None and self.min_bytes is None:
+            return True
+        if self.min_seconds is not None and seconds >= self.min_seconds:
+            return True
+        return self.min_bytes is not None and size is not None and size >= self.min_bytes
+
+    @contextlib.contextmanager
+    def section(self, name: str):
+        profile = cProfile.Profile() if self.profile else None
+        before = None
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            before = tracemalloc.take_snapshot()
+            # reset_peak only exists since python 3.9, older versions report the growth over the section instead
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+
+        started = time.perf_counter()
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # python 3.12+ allows a single active profiler, concurrent sections go without one
+                logger.warning("not profiling %s, another profiler is active", name)
+                profile = None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            seconds = time.perf_counter() - started
+
+            size = None
+            after = None
+            if before is not None:
+                current, peak = tracemalloc.get_traced_memory()
+                size = (peak if hasattr(tracemalloc, "reset_peak") else current) - start_memory
+                after = tracemalloc.take_snapshot()
+
+            logger.info(
+                "%s took %.2fs%s",
+                name,
+                seconds,
+                ", {:.1f} MB peak".format(size / 1024 / 1024) if size is not None else "",
+            )
+            if self.__is_interesting(seconds, size):
+                self.__dump(name, seconds, size, profile, before, after)
+
+    def __dump(
+            self,
+            name: str,
+            seconds: float,
+            size: typing.Optional[int],
+            profile: typing.Optional[cProfile.Profile],
+            before: typing.Optional[tracemalloc.Snapshot],
+            after: typing.Optional[tracemalloc.Snapshot],
+    ):
+        os.makedirs(self.output_dir, exist_ok=True)
+        # sections repeat across runs of a long lived process, each dump gets its own file
+        prefix = os.path.join(
+            self.output_dir,
+            "{}-{:%Y%m%dT%H%M%S}-{}".format(name.replace(os.sep, "_"), datetime.datetime.now(), os.getpid()),
+        )
+
+        if profile is not None:
+            profile.dump_stats(prefix + ".pstats")
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(self.top)
+            with open(prefix + ".profile.txt", "w") as f:
+                f.write(report.getvalue())
+
+        if after is not None:
+            # allocations of the profiler itself would otherwise top the report
+            filters = [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ]
+            before, after = before.filter_traces(filters), after.filter_traces(filters)
+            with open(prefix + ".memory.txt", "w") as f:
+                f.write("{}: {:.2f}s, {:.1f} MB peak\n".format(name, seconds, size / 1024 / 1024))
+                f.write("\nlargest growth since the section started:\n")
+                for stat in after.compare_to(before, "lineno")[:self.top]:
+                    f.write("{}\n".format(stat))
+                f.write("\nlargest live allocations at the end of the section:\n")
+                for stat in after.statistics("traceback")[:self.top]:
+                    f.write("{}\n".format(stat))
+                    for line in stat.traceback.format():
+                        f.write("    {}\n".format(line))
+
+        logger.info("profile of %s written to %s.*", name, prefix)
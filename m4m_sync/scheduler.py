@@ -0,0 +1,202 @@
+import concurrent.futures
+import contextlib
+import datetime
+import logging
+import multiprocessing
+import threading
+import time
+import typing
+
+from m4m_sync.metrics import registry
+from m4m_sync.profiling import Profiler
+from m4m_sync.stores import BaseStore, Sensor
+from m4m_sync.utils import DateTimeRange
+
+logger = logging.getLogger(__name__)
+
+_worker = threading.local()
+
+
+def _init_worker(store_factory, db_factory, upload_limit, collect_metrics=False, profiler=None):
+    # a forked worker starts with a copy of the parent's metrics, which the parent already has
+    if collect_metrics:
+        registry.snapshot(reset=True)
+    _worker.collect_metrics = collect_metrics
+    _worker.profiler = profiler
+    _worker.store = store_factory()
+    _worker.store.upload_limit = upload_limit
+    _worker.db = db_factory()
+
+
+def _sync_sensor(
+        sensor: Sensor,
+        serializer_factory,
+        stream_wrapper_factory,
+        streaming: bool,
+        verify: bool,
+        since: datetime.datetime,
+        watermark: typing.Tuple[datetime.datetime, int] = None,
+) -> typing.Tuple[Sensor, typing.Optional[dict]]:
+    store, db = _worker.store, _worker.db
+    profiler = _worker.profiler.section("sync-{}".format(sensor)) if _worker.profiler else contextlib.nullcontext()
+
+    # the profiler is outermost so writing its reports does not count as sync time
+    with profiler, registry.timer("sync_sensor"):
+        store.prepare_for_sync_sensor(sensor)
+        try:
+            store.sync(
+                sensor=sensor,
+                serializer=serializer_factory(),
+                stream_wrapper=stream_wrapper_factory(context=sensor.id),
+                get_data_by_days=lambda ranges: db.get_sensor_data_by_partitions(
+                    sensor.id,
+                    ranges,
+                    granularity=sensor.partition,
+                    lazy=streaming,
+                ),
+                streaming=streaming,
+                # a run that only looks at recent days must not move the watermark past older changes
+                get_watermark=None if since is not None else (
+                    (lambda: watermark) if watermark is not None else (lambda: db.get_sensor_data_watermark(sensor.id))
+                ),
+                get_fingerprints=lambda checksum_since=None: db.get_sensor_data_fingerprints(
+                    sensor.id,
+                    since=since,
+                    granularity=sensor.partition,
+                    checksum_since=checksum_since,
+                ),
+                verify=verify,
+            )
+        finally:
+            # the session goes back to the pool between sensors instead of living for the whole run
+            db.close_session()
+
+    # process workers hand their metrics back with the result, threads already share the parent's registry
+    return sensor, registry.snapshot(reset=True) if _worker.collect_metrics else None
+
+
+class SyncScheduler:
+    THREAD = "thread"
+    PROCESS = "process"
+
+    def __init__(
+            self,
+            store_factory: typing.Callable[[], BaseStore],
+            db_factory,
+            workers: int = 4,
+            max_uploads: int = None,
+            executor: str = THREAD,
+            streaming: bool = False,
+            profiler: Profiler = None,
+    ):
+        if executor not in (self.THREAD, self.PROCESS):
+            raise ValueError("unknown executor: {}".format(executor))
+
+        self.__store_factory = store_factory
+        self.__db_factory = db_factory
+        self.__workers = workers
+        self.__max_uploads = max_uploads
+        self.__executor = executor
+        self.__streaming = streaming
+        self.__profiler = profiler
+        self.__pool = None
+
+    def __enter__(self) -> "SyncScheduler":
+        # keeps the workers, with their store and database connections, alive across runs
+        self.__pool = self.__create_executor()
+        return self
+
+    def __exit__(self, *exc_info):
+        pool, self.__pool = self.__pool, None
+        pool.shutdown(wait=True)
+
+    def __create_executor(self) -> concurrent.futures.Executor:
+        if self.__executor == self.PROCESS:
+            upload_limit = multiprocessing.BoundedSemaphore(self.__max_uploads) if self.__max_uploads else None
+            return concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.__workers,
+                initializer=_init_worker,
+                initargs=(self.__store_factory, self.__db_factory, upload_limit, True, self.__profiler),
+            )
+
+        upload_limit = threading.BoundedSemaphore(self.__max_uploads) if self.__max_uploads else None
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.__workers,
+            initializer=_init_worker,
+            initargs=(self.__store_factory, self.__db_factory, upload_limit, False, self.__profiler),
+        )
+
+    def run(
+            self,
+            sensors: typing.Iterable[Sensor],
+            serializer_factory,
+            stream_wrapper_factory,
+            verify: bool = False,
+            since: datetime.datetime = None,
+            watermarks: typing.Dict[str, typing.Tuple[datetime.datetime, int]] = None,
+            stop: threading.Event = None,
+            sinces: typing.Dict[str, datetime.datetime] = None,
+    ) -> typing.List[Sensor]:
+        watermarks = watermarks or {}
+        sinces = sinces or {}
+        failed = []
+
+        with contextlib.nullcontext(self.__pool) if self.__pool is not None else self.__create_executor() as executor:
+            futures = {
+                executor.submit(
+                    _sync_sensor,
+                    sensor,
+                    serializer_factory,
+                    stream_wrapper_factory,
+                    self.__streaming,
+                    verify,
+                    sinces.get(sensor.id, since),
+                    watermarks.get(sensor.id),
+                ): sensor
+                for sensor in sensors
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                if stop is not None and stop.is_set():
+                    # sensors already being synced finish, the ones still queued are left for the next run
+                    for pending in futures:
+                        pending.cancel()
+                if future.cancelled():
+                    continue
+
+                sensor = futures[future]
+                try:
+                    _, metrics = future.result()
+                    if metrics is not None:
+                        registry.merge(metrics)
+                    registry.inc("sensors_total", status="synced")
+                    logger.info("Synced sensor %s", sensor)
+                except Exception:
+                    registry.inc("sensors_total", status="failed")
+                    logger.exception("Failed to sync sensor %s", sensor)
+                    failed.append(sensor)
+
+        registry.set("last_run_timestamp_seconds", time.time())
+        return failed
+
+    def watch(
+            self,
+            sensors: typing.Iterable[Sensor],
+            serializer_factory,
+            stream_wrapper_factory,
+            interval: float,
+            stop: threading.Event = None,
+    ):
+        sensors = list(sensors)
+        stop = stop or threading.Event()
+
+        while not stop.wait(interval):
+            failed = self.run(
+                sensors=sensors,
+                serializer_factory=serializer_factory,
+                stream_wrapper_factory=stream_wrapper_factory,
+                # yesterday is included so rows that arrive around midnight are not left to the nightly run
+                since=DateTimeRange.day(-1).start,
+            )
+            if failed:
+                logger.warning("failed to refresh %d sensor(s)", len(failed))
@@ -1,43 +1,209 @@
 import base64
+import binascii
 import csv
+import datetime
 import io
+import itertools
 import json
+import numbers
+import struct
+import typing
+
+import dateutil.parser
+import numpy
+
+from m4m_sync.metrics import registry
+
+
+# the stdlib encoder with json.dumps defaults, faster encoders differ in separators, float repr or escaping
+_json_encode = json.JSONEncoder().encode
+
+
+def _b64encode(value: bytes) -> str:
+    return binascii.b2a_base64(value, newline=False).decode("ascii")
+
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    # the database casts to a timestamp without time zone, which drops any offset, so do the same
+    return dateutil.parser.isoparse(value).replace(tzinfo=None)
+
+
+def parse_value(value: str):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class Record:
+    def __init__(
+            self,
+            timestamp: datetime.datetime,
+            value,
+            signer: bytes = None,
+            sign: bytes = None,
+            data: dict = None,
+    ):
+        self.timestamp = timestamp
+        self.value = value
+        self.signer = signer
+        self.sign = sign
+        self.data = data if data is not None else {"timestamp": timestamp.isoformat(), "value": value}
+
+    def __repr__(self):
+        return "Record({}, {!r})".format(self.timestamp, self.value)
+
+
+def records_to_columns(records: typing.Iterable[Record]) -> dict:
+    records = list(records)
+    if not records:
+        return {}
+
+    values = [record.value for record in records]
+    if any(isinstance(value, dict) for value in values):
+        keys = {}
+        for value in values:
+            if isinstance(value, dict):
+                keys.update(dict.fromkeys(value))
+        value_columns = {
+            key: _to_column([value.get(key) if isinstance(value, dict) else None for value in values])
+            for key in keys
+        }
+    else:
+        value_columns = _to_column(values)
+
+    return {
+        "timestamp": numpy.array([record.timestamp for record in records], dtype="datetime64[us]"),
+        "value": value_columns,
+        "signer": numpy.array([record.signer for record in records], dtype=object),
+        "sign": numpy.array([record.sign for record in records], dtype=object),
+    }
+
+
+def _to_column(values: list) -> numpy.ndarray:
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, bool) for value in present) and len(present) == len(values):
+        return numpy.array(values, dtype=bool)
+    if present and all(isinstance(value, numbers.Real) and not isinstance(value, bool) for value in present):
+        if len(present) == len(values) and all(isinstance(value, numbers.Integral) for value in values):
+            return numpy.array(values, dtype="<i8")
+        return numpy.array([numpy.nan if value is None else value for value in values], dtype="<f8")
+    return numpy.array(values, dtype=object)
+
+
+def filter_columns(columns: dict, start: datetime.datetime, end: datetime.datetime) -> dict:
+    timestamps = columns["timestamp"]
+    mask = (timestamps >= numpy.datetime64(start, "us")) & (timestamps <= numpy.datetime64(end, "us"))
+    if mask.all():
+        return columns
+
+    def apply(column):
+        if isinstance(column, dict):
+            return {key: apply(value) for key, value in column.items()}
+        return column[mask]
+
+    return apply(columns)
 
 
 class BaseSerializer:
+    BLOCK_SIZE = 1024
+
     def serialize(self, out_stream: io.IOBase, data: list):
-        return self._serialize(out_stream, data)
+        # includes the time of the stream wrappers below, and of the upload too when streaming
+        with registry.timer("serialize", serializer=type(self).__name__):
+            return self._serialize(out_stream, data)
 
     def deserialize(self, input_stream: io.IOBase):
         return input_stream.read()
 
+    def deserialize_records(self, input_stream: io.IOBase) -> typing.Iterator[Record]:
+        raise NotImplementedError
+
+    def deserialize_columns(self, input_stream: io.IOBase) -> dict:
+        return records_to_columns(self.deserialize_records(input_stream))
+
     def _serialize(self, out_stream: io.IOBase, data: list):
         pass
 
+    @staticmethod
+    def _peek(data: typing.Iterable) -> typing.Tuple[typing.Any, typing.Iterator]:
+        data = iter(data)
+        first = next(data, None)
+        return first, itertools.chain([first], data) if first is not None else data
+
+    def _blocks(self, data: typing.Iterable) -> typing.Iterator[list]:
+        data = iter(data)
+        while True:
+            block = list(itertools.islice(data, self.BLOCK_SIZE))
+            if not block:
+                return
+            yield block
+
+    @staticmethod
+    def _write_text(out_stream: io.IOBase, text: str, encoding: str = "utf-8"):
+        out_stream.write(text if isinstance(out_stream, io.TextIOBase) else text.encode(encoding))
+
 
 class CsvVerboseSerializer(BaseSerializer):
-    def _serialize(self, out_stream: io.IOBase, data: list):
-        if not data:
+    def _serialize(self, out_stream: io.IOBase, data: typing.Iterable):
+        first, data = self._peek(data)
+        if first is None:
             return
 
-        first_value = data[0].data["value"]
+        first_value = first.data["value"]
         is_multi_value = type(first_value) == dict
 
+        # each block is formatted by the csv module into a string buffer and written in one go
+        buffer = io.StringIO()
+        csv_writer = csv.writer(buffer, delimiter=',', quotechar='"')
+
         if is_multi_value:
-            csv_writer = csv.DictWriter(out_stream, {"timestamp": 1, **first_value}, delimiter=',', quotechar='"')
-            csv_writer.writeheader()
+            fields = list({"timestamp": 1, **first_value})
+            keys = fields[1:]
+            field_set = set(fields)
+            csv_writer.writerow(fields)
+
+        for block in self._blocks(data):
+            if is_multi_value:
+                csv_writer.writerows(self.__multi_value_row(row, keys, field_set) for row in block)
+            else:
+                csv_writer.writerows([row.data["timestamp"], row.data["value"]] for row in block)
+
+            self._write_text(out_stream, buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
 
-            for record in data:
-                csv_writer.writerow({"timestamp": record.data["timestamp"], **record.data["value"]})
+    @staticmethod
+    def __multi_value_row(row, keys: list, fields: set) -> list:
+        # the same row csv.DictWriter would write for {"timestamp": ..., **value}
+        value = row.data["value"]
+        if not value.keys() <= fields:
+            raise ValueError("dict contains fields not in fieldnames: " + ", ".join(
+                repr(key) for key in value if key not in fields
+            ))
+        # a value with its own timestamp field overrides the row's; None and missing keys are both empty fields
+        return [value.get("timestamp", row.data["timestamp"]), *map(value.get, keys)]
+
+    def deserialize_records(self, input_stream: io.IOBase) -> typing.Iterator[Record]:
+        reader = csv.reader(io.TextIOWrapper(input_stream, encoding="utf-8", newline=""), delimiter=',', quotechar='"')
+        first = next(reader, None)
+        if first is None:
+            return
+
+        # multi-value files start with a header row, single values are plain rows
+        if first[0] == "timestamp":
+            keys = first[1:]
+            for row in reader:
+                yield Record(parse_timestamp(row[0]), {key: parse_value(value) for key, value in zip(keys, row[1:])})
         else:
-            csv_writer = csv.writer(out_stream, delimiter=',', quotechar='"')
-            for row in data:
-                csv_writer.writerow([row.data["timestamp"], row.data["value"].value])
+            for row in itertools.chain([first], reader):
+                yield Record(parse_timestamp(row[0]), parse_value(row[1]))
 
 
 class CsvRawSerializer(BaseSerializer):
-    def _serialize(self, out_stream: io.IOBase, data: list):
-        if not data:
+    def _serialize(self, out_stream: io.IOBase, data: typing.Iterable):
+        first, data = self._peek(data)
+        if first is None:
             return
 
         encoding = "utf-8"
@@ -45,10 +211,215 @@ class CsvRawSerializer(BaseSerializer):
 
         out_stream.write("value{d}signer{d}sign\n".format(d=delimeter).encode(encoding))
 
-        for row in data:
-            out_stream.write("{value}{d}{signer}{d}{sign}\n".format(
-                d=delimeter,
-                value=json.dumps(row.data),
-                signer=str(base64.b64encode(row.signer), encoding='utf-8') if row.signer else "",
-                sign=str(base64.b64encode(row.sign), encoding='utf-8') if row.sign else ""
-            ).encode(encoding))
+        # a controller signs all of its rows with the same key, its encoding is worth keeping
+        signers = {}
+        for block in self._blocks(data):
+            lines = []
+            for row in block:
+                signer = row.signer
+                if signer:
+                    encoded_signer = signers.get(signer)
+                    if encoded_signer is None:
+                        encoded_signer = signers[signer] = _b64encode(signer)
+                else:
+                    encoded_signer = ""
+
+                lines.append("".join((
+                    _json_encode(row.data),
+                    delimeter,
+                    encoded_signer,
+                    delimeter,
+                    _b64encode(row.sign) if row.sign else "",
+                    "\n",
+                )))
+            out_stream.write("".join(lines).encode(encoding))
+
+    def deserialize_records(self, input_stream: io.IOBase) -> typing.Iterator[Record]:
+        lines = iter(input_stream)
+        if next(lines, None) is None:
+            return
+
+        for line in lines:
+            # json.dumps escapes tabs and newlines, the delimiter can only be a real one
+            value, signer, sign = line.decode("utf-8").rstrip("\n").split("\t")
+            data = json.loads(value)
+            yield Record(
+                timestamp=parse_timestamp(data["timestamp"]),
+                value=data.get("value"),
+                signer=base64.b64decode(signer) if signer else None,
+                sign=base64.b64decode(sign) if sign else None,
+                data=data,
+            )
+
+
+class ColumnarSerializer(BaseSerializer):
+    MAGIC = b"M4MCOL"
+    VERSION = 1
+
+    TIMESTAMP_DELTA = 1
+    FLOAT64 = 2
+    INT64 = 3
+    BOOL = 4
+    JSON = 5
+    DICTIONARY_BYTES = 6
+    BYTES = 7
+
+    # magic, version, rows, columns
+    __HEADER = struct.Struct("<6sBIH")
+    # name length, type, payload length
+    __COLUMN = struct.Struct("<HBQ")
+    __MISSING = object()
+
+    def _serialize(self, out_stream: io.IOBase, data: typing.Iterable):
+        data = list(data)
+        if not data:
+            return
+
+        columns = [("timestamp", self.TIMESTAMP_DELTA, self.__encode_timestamps([row.data["timestamp"] for row in data]))]
+
+        values = [row.data.get("value") for row in data]
+        if any(isinstance(value, dict) for value in values):
+            keys = {}
+            for value in values:
+                if isinstance(value, dict):
+                    keys.update(dict.fromkeys(value))
+            for key in keys:
+                column = [value.get(key, self.__MISSING) if isinstance(value, dict) else self.__MISSING for value in values]
+                columns.append(("value." + key,) + self.__encode_values(column))
+        else:
+            columns.append(("value",) + self.__encode_values(values))
+
+        columns.append(("signer", self.DICTIONARY_BYTES, self.__encode_dictionary([row.signer for row in data])))
+        columns.append(("sign", self.BYTES, self.__encode_bytes([row.sign for row in data])))
+
+        out_stream.write(self.__HEADER.pack(self.MAGIC, self.VERSION, len(data), len(columns)))
+        for name, kind, payload in columns:
+            name = name.encode("utf-8")
+            out_stream.write(self.__COLUMN.pack(len(name), kind, len(payload)))
+            out_stream.write(name)
+            out_stream.write(payload)
+
+    def deserialize(self, input_stream: io.IOBase) -> dict:
+        data = input_stream.read()
+        if not data:
+            return {}
+
+        magic, version, rows, column_count = self.__HEADER.unpack_from(data)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("not a columnar m4m file")
+
+        result = {}
+        offset = self.__HEADER.size
+        for _ in range(column_count):
+            name_size, kind, payload_size = self.__COLUMN.unpack_from(data, offset)
+            offset += self.__COLUMN.size
+            name = data[offset:offset + name_size].decode("utf-8")
+            offset += name_size
+            column = self.__decode(kind, memoryview(data)[offset:offset + payload_size], rows)
+            offset += payload_size
+
+            if name.startswith("value."):
+                result.setdefault("value", {})[name[len("value."):]] = column
+            else:
+                result[name] = column
+
+        return result
+
+    def deserialize_records(self, input_stream: io.IOBase) -> typing.Iterator[Record]:
+        columns = self.deserialize(input_stream)
+        if not columns:
+            return
+
+        timestamps = columns["timestamp"].astype(datetime.datetime)
+        value = columns["value"]
+        if isinstance(value, dict):
+            lists = {key: column.tolist() for key, column in value.items()}
+            values = [{key: column[i] for key, column in lists.items()} for i in range(len(timestamps))]
+        else:
+            values = value.tolist()
+
+        for timestamp, value, signer, sign in zip(timestamps, values, columns["signer"], columns["sign"]):
+            yield Record(timestamp, value, signer, sign)
+
+    def deserialize_columns(self, input_stream: io.IOBase) -> dict:
+        return self.deserialize(input_stream)
+
+    @staticmethod
+    def __encode_timestamps(timestamps: list) -> bytes:
+        # numpy would convert offsets to UTC, the other serializers and the partition ranges keep the local time
+        parsed = numpy.array([parse_timestamp(timestamp) for timestamp in timestamps], dtype="datetime64[us]")
+        microseconds = parsed.astype("<i8")
+        return numpy.diff(microseconds, prepend=0).astype("<i8").tobytes()
+
+    def __encode_values(self, values: list) -> typing.Tuple[int, bytes]:
+        present = [value for value in values if value is not self.__MISSING]
+        missing = len(present) != len(values)
+
+        if present and all(isinstance(value, bool) for value in present) and not missing:
+            return self.BOOL, numpy.array(values, dtype="u1").tobytes()
+        if present and all(isinstance(value, numbers.Integral) and not isinstance(value, bool) for value in present) \
+                and not missing:
+            return self.INT64, numpy.array(values, dtype="<i8").tobytes()
+        if present and all(isinstance(value, numbers.Real) and not isinstance(value, bool) for value in present):
+            return self.FLOAT64, numpy.array(
+                [numpy.nan if value is self.__MISSING else value for value in values],
+                dtype="<f8",
+            ).tobytes()
+
+        return self.JSON, self.__encode_bytes([
+            None if value is self.__MISSING else json.dumps(value).encode("utf-8") for value in values
+        ])
+
+    @staticmethod
+    def __encode_bytes(values: list) -> bytes:
+        offsets = numpy.zeros(len(values) + 1, dtype="<u4")
+        numpy.cumsum([len(value) if value else 0 for value in values], out=offsets[1:])
+        return offsets.tobytes() + b"".join(value for value in values if value)
+
+    @staticmethod
+    def __encode_dictionary(values: list) -> bytes:
+        dictionary = {}
+        codes = numpy.array(
+            [-1 if value is None else dictionary.setdefault(bytes(value), len(dictionary)) for value in values],
+            dtype="<i4",
+        )
+        entries = b"".join(struct.pack("<I", len(entry)) + entry for entry in dictionary)
+        return struct.pack("<I", len(dictionary)) + entries + codes.tobytes()
+
+    @staticmethod
+    def __decode(kind: int, payload: memoryview, rows: int):
+        if kind == ColumnarSerializer.TIMESTAMP_DELTA:
+            return numpy.cumsum(numpy.frombuffer(payload, dtype="<i8")).astype("datetime64[us]")
+        if kind == ColumnarSerializer.FLOAT64:
+            return numpy.frombuffer(payload, dtype="<f8")
+        if kind == ColumnarSerializer.INT64:
+            return numpy.frombuffer(payload, dtype="<i8")
+        if kind == ColumnarSerializer.BOOL:
+            return numpy.frombuffer(payload, dtype="u1").astype(bool)
+        if kind in (ColumnarSerializer.BYTES, ColumnarSerializer.JSON):
+            offsets = numpy.frombuffer(payload[:(rows + 1) * 4], dtype="<u4")
+            blob = bytes(payload[(rows + 1) * 4:])
+            column = numpy.array([blob[start:end] or None for start, end in zip(offsets[:-1], offsets[1:])], dtype=object)
+            if kind == ColumnarSerializer.JSON:
+                return numpy.array([None if value is None else json.loads(value) for value in column], dtype=object)
+            return column
+        if kind == ColumnarSerializer.DICTIONARY_BYTES:
+            size, = struct.unpack_from("<I", payload)
+            offset = 4
+            dictionary = []
+            for _ in range(size):
+                length, = struct.unpack_from("<I", payload, offset)
+                dictionary.append(bytes(payload[offset + 4:offset + 4 + length]))
+                offset += 4 + length
+            # code -1 picks the trailing None
+            dictionary.append(None)
+            return numpy.array(dictionary, dtype=object)[numpy.frombuffer(payload[offset:], dtype="<i4")]
+        raise ValueError("unknown column type: {}".format(kind))
+
+
+def detect_serializer(data: bytes) -> BaseSerializer:
+    if data.startswith(ColumnarSerializer.MAGIC):
+        return ColumnarSerializer()
+    if data.startswith(b"value\tsigner\tsign\n"):
+        return CsvRawSerializer()
+    return CsvVerboseSerializer()
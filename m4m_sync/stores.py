@@ -1,24 +1,143 @@
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import io
+import itertools
 import logging
 import os
-import pathlib
+import shutil
+import tempfile
+import threading
+import time
 import typing
 import urllib
+import xml.etree.ElementTree
 
 import easywebdav
 import requests
 
-from m4m_sync.serializers import BaseSerializer
-from m4m_sync.utils import DateTimeRange, StreamWrapper, find_in_list
+from m4m_sync.compress import AutoDecompressStreamWrapper, CompressStreamWrapper
+from m4m_sync.manifest import SyncManifest
+from m4m_sync.metrics import registry
+from m4m_sync.serializers import BaseSerializer, Record, detect_serializer, filter_columns
+from m4m_sync.utils import (
+    CountingStreamWrapper,
+    DateTimeRange,
+    DigestStreamWrapper,
+    StreamPipe,
+    StreamWrapper,
+    StreamWrapperChain,
+    find_in_list,
+)
 
 logger = logging.getLogger(__name__)
 
 
+def get_file_name_for_day(date: datetime.datetime) -> str:
+    return "{year}.{month}.{day}.m4m".format(
+        year=date.year,
+        month=date.month,
+        day=date.day,
+    )
+
+
+PARTITION_HOUR = "hour"
+PARTITION_DAY = "day"
+PARTITION_MONTH = "month"
+PARTITIONS = (PARTITION_HOUR, PARTITION_DAY, PARTITION_MONTH)
+
+# the number of numeric parts in a file name tells the granularity, days keep their original names
+_PARTITION_NAME_PARTS = {2: PARTITION_MONTH, 3: PARTITION_DAY, 4: PARTITION_HOUR}
+
+
+def get_partition(point: datetime.datetime, granularity: str = PARTITION_DAY) -> DateTimeRange:
+    if granularity not in PARTITIONS:
+        raise ValueError("unknown partition granularity: {}".format(granularity))
+    return getattr(DateTimeRange, granularity)(point)
+
+
+def get_file_name_for_partition(start: datetime.datetime, granularity: str = PARTITION_DAY) -> str:
+    if granularity == PARTITION_HOUR:
+        return "{year}.{month}.{day}.{hour}.m4m".format(
+            year=start.year,
+            month=start.month,
+            day=start.day,
+            hour=start.hour,
+        )
+    if granularity == PARTITION_MONTH:
+        return "{year}.{month}.m4m".format(year=start.year, month=start.month)
+    return get_file_name_for_day(start)
+
+
+def parse_partition_file_name(name: str) -> typing.Optional[typing.Tuple[str, DateTimeRange]]:
+    if not name.endswith(".m4m"):
+        return None
+
+    parts = name[:-len(".m4m")].split(".")
+    granularity = _PARTITION_NAME_PARTS.get(len(parts))
+    if granularity is None or not all(part.isdigit() for part in parts):
+        return None
+
+    try:
+        start = datetime.datetime(*(int(part) for part in parts), *([1] * (3 - len(parts))))
+    except ValueError:
+        return None
+    return granularity, get_partition(start, granularity)
+
+
+def get_partition_granularity(name: str) -> typing.Optional[str]:
+    parsed = parse_partition_file_name(name)
+    return parsed[0] if parsed is not None else None
+
+
+def find_partitions(files: typing.Iterable["File"], range: DateTimeRange) -> typing.List[str]:
+    partitions = []
+    for file in files:
+        parsed = None if file.is_dir else parse_partition_file_name(file.name)
+        if parsed is not None and parsed[1].overlaps(range):
+            partitions.append((parsed[1].start, file.name))
+    return [name for _, name in sorted(partitions)]
+
+
+def get_sync_days(first_date: datetime.datetime) -> typing.List[DateTimeRange]:
+    first_date_range = DateTimeRange.day(first_date)
+    result = []
+    i = 2
+
+    while True:
+        current_range = DateTimeRange.day(i)
+        if current_range.start < first_date_range.start:
+            break
+
+        result.append(current_range)
+        i -= 1
+
+    return result
+
+
+def decode_partition(data: bytes, stream_wrapper_factory: typing.Callable[[], StreamWrapper] = None) -> bytes:
+    file = io.BytesIO(data)
+    stream = stream_wrapper_factory()(file) if stream_wrapper_factory else file
+    with AutoDecompressStreamWrapper()(stream) as stream:
+        return stream.read()
+
+
 class File:
-    def __init__(self, name: str, is_dir: bool):
+    def __init__(
+            self,
+            name: str,
+            is_dir: bool,
+            size: int = None,
+            mtime: typing.Union[float, str] = None,
+            etag: str = None,
+    ):
         self.name = name
         self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
 
     def __str__(self):
         return self.name
@@ -30,6 +149,58 @@ class File:
             return self.name == other.name and self.is_dir == other.is_dir
 
 
+class DirectoryIndex:
+    def __init__(self):
+        self.__listings = {}
+
+    @staticmethod
+    def __key(path: str) -> str:
+        return path.strip("/")
+
+    def is_listed(self, path: str) -> bool:
+        return self.__key(path) in self.__listings
+
+    def get(self, path: str) -> typing.Optional[typing.List[File]]:
+        listing = self.__listings.get(self.__key(path))
+        if listing is not None:
+            return list(listing.values())
+
+    def find(self, path: str, name: str) -> typing.Optional[File]:
+        listing = self.__listings.get(self.__key(path))
+        if listing is not None:
+            return listing.get(name)
+
+    def set(self, path: str, files: typing.List[File]):
+        self.__listings[self.__key(path)] = {file.name: file for file in files}
+
+    def add(self, path: str, is_dir: bool):
+        key = self.__key(path)
+        parent, name = os.path.split(key)
+        listing = self.__listings.get(parent)
+        if listing is not None:
+            listing[name] = File(name=name, is_dir=is_dir)
+        if is_dir:
+            self.__listings[key] = {}
+
+    def remove(self, path: str):
+        key = self.__key(path)
+        parent, name = os.path.split(key)
+        listing = self.__listings.get(parent)
+        if listing is not None:
+            listing.pop(name, None)
+        self.invalidate(key)
+
+    def invalidate(self, path: str = None):
+        key = self.__key(path) if path is not None else ""
+        if not key:
+            self.__listings.clear()
+            return
+
+        for cached in list(self.__listings):
+            if cached == key or cached.startswith(key + "/"):
+                del self.__listings[cached]
+
+
 class Controller:
     def __init__(self, mac: str = None, name: str = None):
         self.name = name
@@ -43,10 +214,14 @@ class Controller:
 
 
 class Sensor:
-    def __init__(self, id: str = None, name: str = None, controller: Controller = None):
+    def __init__(self, id: str = None, name: str = None, controller: Controller = None, partition: str = PARTITION_DAY):
+        if partition not in PARTITIONS:
+            raise ValueError("unknown partition granularity: {}".format(partition))
+
         self.name = name
         self.id = id
         self.controller = controller
+        self.partition = partition
 
     def __str__(self):
         return "{id}".format(name=self.name, id=self.id)
@@ -55,20 +230,91 @@ class Sensor:
         return self.id == other.id
 
 
+_requests = threading.local()
+
+
+@contextlib.contextmanager
+def _request_timer(store: "BaseStore", operation: str):
+    # hooks call each other (_replace -> _upload -> _open_upload) and CachedStore calls the wrapped store's,
+    # only the outermost call on a thread is the request
+    if getattr(_requests, "active", False):
+        yield
+        return
+
+    _requests.active = True
+    try:
+        with registry.timer("store_request", store=type(store).__name__, operation=operation):
+            yield
+    finally:
+        _requests.active = False
+
+
+def _instrument_request(operation: str, method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with _request_timer(self, operation):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _instrument_open(operation: str, method):
+    # an open upload is timed until it is closed, that is when the data actually reaches the store
+    @functools.wraps(method)
+    @contextlib.contextmanager
+    def wrapper(self, *args, **kwargs):
+        with _request_timer(self, operation):
+            with method(self, *args, **kwargs) as stream:
+                yield stream
+    return wrapper
+
+
 class BaseStore:
     ROOT = "M4M"
     __SENSOR_NAME_PREFIX = "."
     __CONTROLLER_NAME_PREFIX = "."
+    __REQUESTS = (
+        "_upload",
+        "_move",
+        "_replace",
+        "_get_download_stream",
+        "_get_download_stream_if_changed",
+        "_create_folder",
+        "_ls",
+        "_rm",
+    )
+    __OPEN_REQUESTS = ("_open_upload", "_open_replace")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # every backend hook is counted and timed per store class without each backend having to remember it
+        for name in BaseStore.__REQUESTS:
+            if name in cls.__dict__:
+                setattr(cls, name, _instrument_request(name[1:], cls.__dict__[name]))
+        for name in BaseStore.__OPEN_REQUESTS:
+            if name in cls.__dict__:
+                setattr(cls, name, _instrument_open(name[1:], cls.__dict__[name]))
 
     def __init__(self):
+        self.upload_limit = None
+        self.__index = DirectoryIndex()
         self.__create_root_dir()
 
+    def invalidate(self, *paths: str):
+        if paths:
+            self.__index.invalidate(self.__join(*paths))
+        else:
+            self.__index.invalidate()
+
+    def refresh(self, *paths: str):
+        self.invalidate(*paths)
+        self.__ls(self.__join(*paths))
+
     def get_controllers(self) -> typing.List[Controller]:
         result = []
-        for file in self._ls(self.__join()):
+        for file in self.__ls(self.__join()):
             if file.is_dir:
                 controller_mac = file.name
-                files = self._ls(self.__join(str(file)))
+                files = self.__ls(self.__join(str(file)))
                 controller_file = find_in_list(files, lambda file: file.name.startswith(self.__CONTROLLER_NAME_PREFIX))
                 if controller_file:
                     sensor_name = urllib.parse.unquote(controller_file.name[1:])
@@ -79,10 +325,10 @@ class BaseStore:
 
     def get_sensors(self, controller: Controller) -> typing.List[Sensor]:
         result = []
-        for file in self._ls(self.__join(str(controller))):
+        for file in self.__ls(self.__join(str(controller))):
             if file.is_dir:
                 sensor_id = file.name
-                files = self._ls(self.__join(str(controller), sensor_id))
+                files = self.__ls(self.__join(str(controller), sensor_id))
                 sensor_file = find_in_list(files, lambda file: file.name.startswith(self.__SENSOR_NAME_PREFIX))
                 if sensor_file:
                     sensor_name = urllib.parse.unquote(sensor_file.name[1:])
@@ -94,135 +340,419 @@ class BaseStore:
     def _upload(self, stream: io.IOBase, path: str):
         raise NotImplementedError
 
+    @contextlib.contextmanager
+    def _open_upload(self, path: str) -> typing.Iterator[io.IOBase]:
+        with tempfile.SpooledTemporaryFile(max_size=StreamPipe.CHUNK_SIZE) as temp_stream:
+            yield temp_stream
+            temp_stream.seek(0)
+            self._upload(temp_stream, path)
+
+    def _move(self, source: str, destination: str):
+        raise NotImplementedError
+
+    def _replace(self, stream: io.IOBase, path: str):
+        temp_path = path + ".part"
+        self._upload(stream, temp_path)
+        self._move(temp_path, path)
+
+    @contextlib.contextmanager
+    def _open_replace(self, path: str) -> typing.Iterator[io.IOBase]:
+        temp_path = path + ".part"
+        with self._open_upload(temp_path) as stream:
+            yield stream
+        self._move(temp_path, path)
+
     def _get_download_stream(self, path: str):
         raise NotImplementedError
 
+    def _get_download_stream_if_changed(
+            self,
+            path: str,
+            etag: typing.Optional[str],
+    ) -> typing.Tuple[typing.Optional[io.IOBase], typing.Optional[str]]:
+        return self._get_download_stream(path), None
+
+    def _stat(self, path: str) -> typing.Optional[File]:
+        parent, name = os.path.split(path)
+        return self.__find(parent, name)
+
     def _create_folder(self, path: str):
         raise NotImplementedError
 
     def _ls(self, path: str) -> typing.List[File]:
         raise NotImplementedError
 
+    def _rm(self, path: str):
+        raise NotImplementedError
+
+    def __ls(self, path: str) -> typing.List[File]:
+        files = self.__index.get(path)
+        if files is None:
+            files = self._ls(path)
+            self.__index.set(path, files)
+        return files
+
+    def __find(self, path: str, name: str) -> typing.Optional[File]:
+        if not self.__index.is_listed(path):
+            self.__ls(path)
+        return self.__index.find(path, name)
+
+    def __upload(self, stream: io.IOBase, path: str, replace: bool = False):
+        with self.upload_limit or contextlib.nullcontext():
+            if replace:
+                self._replace(stream, path)
+            else:
+                self._upload(stream, path)
+        self.__index.add(path, is_dir=False)
+
+    @contextlib.contextmanager
+    def __open_upload(self, path: str, replace: bool = False) -> typing.Iterator[io.IOBase]:
+        with self.upload_limit or contextlib.nullcontext():
+            with (self._open_replace(path) if replace else self._open_upload(path)) as stream:
+                yield stream
+        self.__index.add(path, is_dir=False)
+
+    def __create_folder(self, path: str):
+        self._create_folder(path)
+        self.__index.add(path, is_dir=True)
+
+    def __rm(self, path: str):
+        self._rm(path)
+        self.__index.remove(path)
+
     def __join(self, *paths: str) -> str:
         return os.path.join(self.ROOT, *paths)
 
     def __contains_dir(self, path: str, dir_name: str) -> bool:
-        return find_in_list(self._ls(self.__join(path)), lambda file: file.is_dir and file.name == dir_name) is not None
+        file = self.__find(self.__join(path), dir_name)
+        return file is not None and file.is_dir
 
     def __contains_file(self, path: str, file_name: str) -> bool:
-        return find_in_list(
-            self._ls(self.__join(path)),
-            lambda file: not file.is_dir and file.name == file_name,
-        ) is not None
-
-    @staticmethod
-    def __get_file_name_for_day(date: datetime.datetime) -> str:
-        return "{year}.{month}.{day}.m4m".format(
-            year=date.year,
-            month=date.month,
-            day=date.day,
-        )
+        file = self.__find(self.__join(path), file_name)
+        return file is not None and not file.is_dir
 
     def __create_root_dir(self):
-        files = self._ls("/")
-        if self.ROOT not in [file.name for file in files]:
+        if self.__find("/", self.ROOT) is None:
             logger.info("creating root folder")
-            self._create_folder(self.ROOT)
+            self.__create_folder(self.ROOT)
 
     def prepare_for_sync_controller(self, controller: Controller):
-        remote_controllers = self.get_controllers()
-        if controller not in remote_controllers:
-            self._create_folder(self.__join(str(controller)))
+        if not self.__contains_dir("", str(controller)):
+            self.__create_folder(self.__join(str(controller)))
 
-        files = self._ls(self.__join(str(controller)))
+        files = self.__ls(self.__join(str(controller)))
         file_controller_name = find_in_list(files, lambda file: file.name.startswith(self.__CONTROLLER_NAME_PREFIX))
 
         controller_name_file_path = self.__join(str(controller), self.__CONTROLLER_NAME_PREFIX + controller.name)
 
         if not file_controller_name:
-            self._upload(io.BytesIO(), controller_name_file_path)
+            self.__upload(io.BytesIO(), controller_name_file_path)
         elif file_controller_name.name[1:] != controller.name:
-            self._rm(self.__join(str(controller), file_controller_name.name))
-            self._upload(io.BytesIO(), controller_name_file_path)
+            self.__rm(self.__join(str(controller), file_controller_name.name))
+            self.__upload(io.BytesIO(), controller_name_file_path)
 
     def prepare_for_sync_sensor(self, sensor: Sensor):
-        remote_sensors = self.get_sensors(sensor.controller)
-
-        if sensor not in remote_sensors:
-            self._create_folder(self.__join(str(sensor.controller), str(sensor)))
+        if not self.__contains_dir(str(sensor.controller), str(sensor)):
+            self.__create_folder(self.__join(str(sensor.controller), str(sensor)))
 
-        files = self._ls(self.__join(str(sensor.controller), str(sensor)))
+        files = self.__ls(self.__join(str(sensor.controller), str(sensor)))
         file_sensor_name = find_in_list(files, lambda file: file.name.startswith(self.__SENSOR_NAME_PREFIX))
 
         sensor_name_file_path = self.__join(str(sensor.controller), str(sensor),
                                             self.__SENSOR_NAME_PREFIX + sensor.name)
 
         if not file_sensor_name:
-            self._upload(io.BytesIO(), sensor_name_file_path)
+            self.__upload(io.BytesIO(), sensor_name_file_path)
         elif file_sensor_name.name[1:] != sensor.name:
-            self._rm(self.__join(str(sensor.controller), str(sensor), file_sensor_name.name))
-            self._upload(io.BytesIO(), sensor_name_file_path)
+            self.__rm(self.__join(str(sensor.controller), str(sensor), file_sensor_name.name))
+            self.__upload(io.BytesIO(), sensor_name_file_path)
+
+    def __read_manifest(self, sensor_path: str, stream_wrapper: StreamWrapper) -> typing.Optional[SyncManifest]:
+        if not self.__find(sensor_path, SyncManifest.NAME):
+            return None
+
+        with self._get_download_stream(os.path.join(sensor_path, SyncManifest.NAME)) as file:
+            data = file.read()
+
+        try:
+            if data.startswith(b"{"):
+                # written before manifests were encrypted, it is encrypted when it is written back
+                manifest = SyncManifest.loads(data)
+                manifest.dirty = True
+                return manifest
+            # sniffed like a partition, so a manifest written under another --compression stays readable
+            wrappers = stream_wrapper.wrappers if isinstance(stream_wrapper, StreamWrapperChain) else (stream_wrapper,)
+            decryptor = StreamWrapperChain(*[
+                wrapper for wrapper in wrappers
+                if wrapper is not None and not isinstance(wrapper, CompressStreamWrapper)
+            ])
+            return SyncManifest.loads(decode_partition(data, lambda: decryptor))
+        except Exception:
+            logger.warning("Ignoring unreadable manifest in %s", sensor_path, exc_info=True)
+            return None
+
+    def __write_manifest(self, sensor_path: str, manifest: SyncManifest, stream_wrapper: StreamWrapper):
+        # row counts and plaintext digests say as much about the data as the partitions do
+        with io.BytesIO() as temp_stream:
+            with stream_wrapper(stream=temp_stream) as wrapped_stream:
+                wrapped_stream.write(manifest.dumps())
+
+            temp_stream.seek(0)
+            path = os.path.join(sensor_path, SyncManifest.NAME)
+            self.__upload(temp_stream, path, replace=self.__find(sensor_path, SyncManifest.NAME) is not None)
+
+    def __bootstrap_manifest(self, sensor_path: str, partitions: typing.Dict[str, tuple]) -> SyncManifest:
+        manifest = SyncManifest()
+        synced = sorted(
+            (partition.start, name) for name, (partition, _) in partitions.items()
+            if self.__find(sensor_path, name)
+        )
 
-    def sync(
+        # the newest file of a store synced without a manifest was usually written while it was still filling up
+        for _, name in synced[:-1]:
+            manifest.set(name, partitions[name][1], None)
+        return manifest
+
+    def __sync_partition(
             self,
             sensor: Sensor,
+            path: str,
+            data: typing.Iterable,
             serializer: BaseSerializer,
             stream_wrapper: StreamWrapper,
-            first_date: datetime.datetime,
-            get_data,
-    ):
-        files = self._ls(self.__join(str(sensor.controller), str(sensor)))
-
-        first_date_range = DateTimeRange.day(first_date)
-        i = 2
-
-        while True:
-            current_range = DateTimeRange.day(i)
-            if current_range.start < first_date_range.start:
-                break
-
-            file_name = self.__get_file_name_for_day(current_range.start)
-            if file_name in files:
-                i -= 1
-                continue
-
-            sensor_data_file_name = self.__join(str(sensor.controller), str(sensor), file_name)
-
-            data = get_data(current_range)
-            if not data:
-                i -= 1
-                continue
-
-            logger.info("Converting %s", sensor_data_file_name)
+            streaming: bool,
+            replace: bool,
+    ) -> str:
+        started = time.perf_counter()
+        rows = [0]
+
+        def count(data):
+            for row in data:
+                rows[0] += 1
+                yield row
+
+        if streaming:
+            logger.info("Streaming %s", path)
+            with self.__open_upload(path, replace=replace) as out_stream:
+                counter = CountingStreamWrapper()(out_stream)
+                with stream_wrapper(stream=counter) as wrapped_stream:
+                    digest = DigestStreamWrapper()(wrapped_stream)
+                    serializer.serialize(
+                        out_stream=digest,
+                        data=count(data),
+                    )
+        else:
+            logger.info("Converting %s", path)
             with io.BytesIO() as temp_stream:
-                with stream_wrapper(stream=temp_stream) as wrapped_stream:
+                counter = CountingStreamWrapper()(temp_stream)
+                with stream_wrapper(stream=counter) as wrapped_stream:
+                    digest = DigestStreamWrapper()(wrapped_stream)
                     serializer.serialize(
-                        out_stream=wrapped_stream,
-                        data=data,
+                        out_stream=digest,
+                        data=count(data),
                     )
 
-                logger.info("Saving %s", sensor_data_file_name)
+                logger.info("Saving %s", path)
                 temp_stream.seek(0)
-                self._upload(temp_stream, sensor_data_file_name)
+                self.__upload(temp_stream, path, replace=replace)
+
+        registry.add_partition(
+            sensor=str(sensor),
+            partition=os.path.basename(path),
+            rows=rows[0],
+            size=counter.count,
+            seconds=time.perf_counter() - started,
+        )
+        return digest.hexdigest()
 
-                i -= 1
+    def sync(
+            self,
+            sensor: Sensor,
+            serializer: BaseSerializer,
+            stream_wrapper: StreamWrapper,
+            first_date: datetime.datetime = None,
+            get_data=None,
+            get_data_by_days=None,
+            streaming: bool = False,
+            get_watermark=None,
+            get_fingerprints=None,
+            verify: bool = False,
+    ):
+        sensor_path = self.__join(str(sensor.controller), str(sensor))
+        granularity = sensor.partition
+        manifest = None
+        superseded = []
+        persist = True
+        watermark = None
+        partitions = {}
+
+        if get_fingerprints is None:
+            if granularity != PARTITION_DAY:
+                raise ValueError("{} partitions need fingerprints to sync".format(granularity))
+
+            missing = [
+                current_range for current_range in get_sync_days(first_date)
+                if not self.__find(sensor_path, get_file_name_for_day(current_range.start))
+            ]
+        else:
+            manifest = self.__read_manifest(sensor_path, stream_wrapper)
+            watermark = get_watermark() if get_watermark is not None else None
+            # files of another granularity are left over from before the sensor's partitioning changed
+            superseded = [
+                file.name for file in self.__ls(sensor_path)
+                if not file.is_dir and get_partition_granularity(file.name) not in (None, granularity)
+            ]
+            up_to_date = manifest is not None and watermark is not None and manifest.is_current(*watermark)
+            if up_to_date and not verify and not superseded:
+                logger.info("Sensor %s is up to date", sensor)
+                return
+
+            # partitions before the last full run's watermark are only checksummed again with --verify
+            checksum_since = manifest.watermark if manifest is not None and not verify else None
+            for start, fingerprint in get_fingerprints(checksum_since).items():
+                name = get_file_name_for_partition(start, granularity)
+                partitions[name] = (get_partition(start, granularity), fingerprint)
+
+            if manifest is None:
+                manifest = self.__bootstrap_manifest(sensor_path, partitions)
+                # without a watermark the fingerprints may only cover recent partitions, leave it to a full run
+                persist = watermark is not None
+            missing = sorted(
+                (partition for name, (partition, fingerprint) in partitions.items()
+                 if manifest.is_changed(name, fingerprint)),
+                key=lambda partition: partition.start,
+            )
+
+        # get_data_by_days is handed the partition ranges, which are only days for the default granularity
+        if get_data_by_days is not None:
+            chunks = get_data_by_days(missing)
+        else:
+            chunks = ((current_range, get_data(current_range)) for current_range in missing)
+
+        try:
+            for current_range, data in chunks:
+                # data may be a lazy row iterator, peek instead of len()
+                data = iter(data)
+                first_row = next(data, None)
+                if first_row is None:
+                    continue
+
+                name = get_file_name_for_partition(current_range.start, granularity)
+                digest = self.__sync_partition(
+                    sensor=sensor,
+                    path=os.path.join(sensor_path, name),
+                    data=itertools.chain([first_row], data),
+                    serializer=serializer,
+                    stream_wrapper=stream_wrapper,
+                    streaming=streaming,
+                    # partitions that were uploaded before are swapped in whole, readers never see a partial file
+                    replace=manifest is not None and manifest.get(name) is not None,
+                )
+                if manifest is not None:
+                    # the fingerprint is from before the rows were read, rows added since show up on the next run
+                    manifest.set(name, partitions[name][1], digest)
+
+            if manifest is not None and watermark is not None:
+                # a full run has just written every partition with data at the current granularity
+                for name in superseded:
+                    logger.info("Removing %s, superseded by %s partitions", name, granularity)
+                    self.__rm(os.path.join(sensor_path, name))
+                    manifest.remove(name)
+                manifest.set_watermark(*watermark)
+        finally:
+            if manifest is not None and manifest.dirty and persist:
+                self.__write_manifest(sensor_path, manifest, stream_wrapper)
 
     def get(self, sensor: Sensor, range: DateTimeRange, stream_wrapper: StreamWrapper) -> typing.List[bytes]:
         result = []
 
-        files = self._ls(self.__join(str(sensor.controller), str(sensor)))
-        current_day = range.start
-        while current_day <= range.end:
-            file_name = self.__get_file_name_for_day(current_day)
-            if find_in_list(files, lambda file: file.name == file_name):
-                with self._get_download_stream(self.__join(str(sensor.controller), str(sensor), file_name)) as file:
-                    with stream_wrapper(file) as stream:
-                        result.append(stream.read())
-            current_day = current_day + datetime.timedelta(days=1)
+        sensor_path = self.__join(str(sensor.controller), str(sensor))
+        for file_name in find_partitions(self.__ls(sensor_path), range):
+            with self._get_download_stream(os.path.join(sensor_path, file_name)) as file:
+                counter = CountingStreamWrapper()(file)
+                with AutoDecompressStreamWrapper()(stream_wrapper(counter) if stream_wrapper else counter) as stream:
+                    result.append(stream.read())
+            registry.inc("store_bytes_total", counter.count, direction="in")
 
         return result
 
 
+    def __read_partition(
+            self,
+            path: str,
+            stream_wrapper_factory: typing.Callable[[], StreamWrapper],
+            executor: concurrent.futures.Executor,
+    ) -> bytes:
+        with self._get_download_stream(path) as file:
+            data = file.read()
+        registry.inc("store_bytes_total", len(data), direction="in")
+
+        if executor is None:
+            return decode_partition(data, stream_wrapper_factory)
+        return executor.submit(decode_partition, data, stream_wrapper_factory).result()
+
+    def read(
+            self,
+            sensor: Sensor,
+            range: DateTimeRange,
+            stream_wrapper_factory: typing.Callable[[], StreamWrapper] = None,
+            workers: int = 4,
+            read_ahead: int = 8,
+            executor: concurrent.futures.Executor = None,
+    ) -> typing.Iterator[bytes]:
+        sensor_path = self.__join(str(sensor.controller), str(sensor))
+        paths = iter([
+            os.path.join(sensor_path, file_name)
+            for file_name in find_partitions(self.__ls(sensor_path), range)
+        ])
+
+        # downloads run on the pool, decoding too unless a separate executor (e.g. processes) is given
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = collections.deque(
+                pool.submit(self.__read_partition, path, stream_wrapper_factory, executor)
+                for path in itertools.islice(paths, max(read_ahead, 1))
+            )
+            try:
+                while pending:
+                    data = pending.popleft().result()
+                    for path in itertools.islice(paths, 1):
+                        pending.append(pool.submit(self.__read_partition, path, stream_wrapper_factory, executor))
+                    yield data
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def query(
+            self,
+            sensor: Sensor,
+            range: DateTimeRange,
+            stream_wrapper_factory: typing.Callable[[], StreamWrapper] = None,
+            serializer: BaseSerializer = None,
+            columnar: bool = False,
+            **kwargs
+    ) -> typing.Iterator[typing.Union[Record, dict]]:
+        # partitions usually cover more than the range, rows outside of it are dropped
+        for data in self.read(sensor, range, stream_wrapper_factory, **kwargs):
+            current_serializer = serializer or detect_serializer(data)
+
+            if not columnar:
+                for record in current_serializer.deserialize_records(io.BytesIO(data)):
+                    if range.start <= record.timestamp <= range.end:
+                        yield record
+                continue
+
+            columns = current_serializer.deserialize_columns(io.BytesIO(data))
+            if columns:
+                columns = filter_columns(columns, range.start, range.end)
+                if len(columns["timestamp"]):
+                    yield columns
+
+
+# the umask can only be read by setting it, do it once before any worker threads exist
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
 class LocalStore(BaseStore):
     def __init__(self, root: str, *args, **kwargs):
         self.__root = root
@@ -237,39 +767,101 @@ class LocalStore(BaseStore):
         os.makedirs(self.__normalize_path(path))
 
     def _ls(self, path: str) -> typing.List[File]:
-        path = self.__normalize_path(path)
-        return [File(name=f, is_dir=os.path.isdir(os.path.join(path, f))) for f in os.listdir(path)]
+        result = []
+        with os.scandir(self.__normalize_path(path)) as entries:
+            for entry in entries:
+                stat = entry.stat()
+                result.append(File(name=entry.name, is_dir=entry.is_dir(), size=stat.st_size, mtime=stat.st_mtime))
+        return result
 
     def _rm(self, path: str):
         os.remove(self.__normalize_path(path))
 
     def _upload(self, stream: io.IOBase, path: str):
+        with self._open_upload(path) as out_stream:
+            shutil.copyfileobj(stream, out_stream)
+
+    @contextlib.contextmanager
+    def _open_upload(self, path: str) -> typing.Iterator[io.IOBase]:
         path = self.__normalize_path(path)
 
-        pathlib.Path(path).write_bytes(stream.getbuffer())
+        temp_stream = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path),
+            prefix=os.path.basename(path),
+            suffix=".part",
+            delete=False,
+        )
+        try:
+            with temp_stream:
+                yield temp_stream
+            # temporary files are private, the final file gets the permissions open() would have given it
+            os.chmod(temp_stream.name, 0o666 & ~_UMASK)
+            os.replace(temp_stream.name, path)
+        except BaseException:
+            os.remove(temp_stream.name)
+            raise
+
+    def _replace(self, stream: io.IOBase, path: str):
+        self._upload(stream, path)
+
+    def _open_replace(self, path: str) -> typing.ContextManager[io.IOBase]:
+        return self._open_upload(path)
+
+    def _move(self, source: str, destination: str):
+        os.replace(self.__normalize_path(source), self.__normalize_path(destination))
 
     def _get_download_stream(self, path: str):
         return open(self.__normalize_path(path), 'rb')
 
 
 class WebDavStore(BaseStore):
-    def __init__(self, uri: str, auth=None, username: str = None, password: str = None, protocol=None, *args, **kwargs):
+    def __init__(
+            self,
+            uri: str,
+            auth=None,
+            username: str = None,
+            password: str = None,
+            protocol=None,
+            port: int = 0,
+            pool_size: int = 16,
+            *args,
+            **kwargs
+    ):
         self.__webdav = easywebdav.Client(
             uri,
+            port=port,
             auth=auth,
             username=username,
             password=password,
-            protocol=protocol,
+            protocol=protocol or "http",
         )
+        # concurrent reads share the session, keep their connections alive
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.__webdav.session.mount("http://", adapter)
+        self.__webdav.session.mount("https://", adapter)
         super().__init__(*args, **kwargs)
 
     def _ls(self, path: str) -> typing.List[File]:
-        return [
-            File(
-                name=os.path.basename(file.name.strip('/')),
-                is_dir=file.name.endswith('/'),
-            ) for file in self.__webdav.ls(path) if '/' + path + '/' != file.name
-        ]
+        # easywebdav.ls() drops the etag, so the PROPFIND response is parsed here
+        response = self.__webdav._send('PROPFIND', path, (207, 301), headers={'Depth': '1'})
+        if response.status_code == 301:
+            return self._ls(urllib.parse.urlparse(response.headers['location']).path)
+
+        result = []
+        for element in xml.etree.ElementTree.fromstring(response.content).iter('{DAV:}response'):
+            name = element.findtext('{DAV:}href')
+            if '/' + path + '/' == name:
+                continue
+
+            size = element.findtext('.//{DAV:}getcontentlength')
+            result.append(File(
+                name=os.path.basename(name.strip('/')),
+                is_dir=name.endswith('/'),
+                size=int(size) if size else None,
+                mtime=element.findtext('.//{DAV:}getlastmodified'),
+                etag=element.findtext('.//{DAV:}getetag'),
+            ))
+        return result
 
     def _create_folder(self, path: str):
         self.__webdav.mkdir(path)
@@ -280,12 +872,54 @@ class WebDavStore(BaseStore):
     def _upload(self, stream: io.IOBase, path: str):
         self.__webdav._upload(stream, path)
 
+    def _move(self, source: str, destination: str):
+        self.__webdav._send('MOVE', source, (201, 204), headers={
+            'Destination': self.__webdav._get_url(destination),
+            'Overwrite': 'T',
+        })
+
+    @contextlib.contextmanager
+    def _open_upload(self, path: str) -> typing.Iterator[io.IOBase]:
+        pipe = StreamPipe()
+
+        def upload():
+            try:
+                # a generator body makes requests send the file with chunked transfer encoding
+                self.__webdav._send('PUT', path, (200, 201, 204), data=iter(pipe))
+            except BaseException as e:
+                pipe.fail(e)
+
+        thread = threading.Thread(target=upload, daemon=True)
+        thread.start()
+        try:
+            yield pipe
+            pipe.close()
+        except BaseException as e:
+            pipe.abort(e)
+            raise
+        finally:
+            thread.join()
+
+        if pipe.error is not None:
+            raise pipe.error
+
     def _get_download_stream(self, path: str):
-        response = self.__webdav._send('GET', path, 200, stream=True)
+        return self._get_download_stream_if_changed(path, None)[0]
+
+    def _get_download_stream_if_changed(
+            self,
+            path: str,
+            etag: typing.Optional[str],
+    ) -> typing.Tuple[typing.Optional[io.IOBase], typing.Optional[str]]:
+        headers = {'If-None-Match': etag} if etag else {}
+        response = self.__webdav._send('GET', path, (200, 304), stream=True, headers=headers)
+        if response.status_code == 304:
+            return None, etag
+
         result = io.BytesIO()
         self.__webdav._download(result, response)
         result.seek(0)
-        return result
+        return result, response.headers.get('ETag')
 
 
 class YaDiskStore(WebDavStore):
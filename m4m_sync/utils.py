@@ -1,7 +1,9 @@
 import calendar
 import datetime
 import dateutil.relativedelta
+import hashlib
 import io
+import queue
 import typing
 
 
@@ -17,7 +19,7 @@ class DateTimeRange:
     @staticmethod
     def month(point: typing.Union[datetime.datetime, int, None] = None):
         if type(point) == int:
-            return DateTimeRange.day(DateTimeRange.__move_from_now(months=point))
+            return DateTimeRange.month(DateTimeRange.__move_from_now(months=point))
 
         if point is None:
             point = datetime.datetime.now()
@@ -28,6 +30,10 @@ class DateTimeRange:
                 year=point.year,
                 month=point.month,
                 day=calendar.monthrange(point.year, point.month)[1],
+                hour=23,
+                minute=59,
+                second=59,
+                microsecond=999999,
             ),
         )
 
@@ -52,21 +58,69 @@ class DateTimeRange:
             ),
         )
 
+    @staticmethod
+    def hour(point: typing.Union[datetime.datetime, int, None] = None):
+        if type(point) == int:
+            return DateTimeRange.hour(DateTimeRange.__move_from_now(hours=point))
+
+        if point is None:
+            point = datetime.datetime.now()
+
+        return DateTimeRange(
+            start=datetime.datetime(year=point.year, month=point.month, day=point.day, hour=point.hour),
+            end=datetime.datetime(
+                year=point.year,
+                month=point.month,
+                day=point.day,
+                hour=point.hour,
+                minute=59,
+                second=59,
+                microsecond=999999,
+            ),
+        )
+
+    def overlaps(self, other: "DateTimeRange") -> bool:
+        return self.start <= other.end and other.start <= self.end
+
+    @staticmethod
+    def merge(ranges: typing.Iterable["DateTimeRange"]) -> typing.List["DateTimeRange"]:
+        result = []
+        for current in sorted(ranges, key=lambda r: r.start):
+            if result and current.start <= result[-1].end + datetime.timedelta(microseconds=1):
+                result[-1] = DateTimeRange(start=result[-1].start, end=max(result[-1].end, current.end))
+            else:
+                result.append(DateTimeRange(start=current.start, end=current.end))
+        return result
+
     def __str__(self):
         return "{} - {}".format(self.start, self.end)
 
 
 class StreamWrapper(io.RawIOBase):
-    def __init__(self, stream: io.BufferedIOBase = None, close_source: bool = False, *args, **kwargs):
+    def __init__(
+            self,
+            stream: io.BufferedIOBase = None,
+            close_source: bool = False,
+            context: str = None,
+            *args,
+            **kwargs
+    ):
         super().__init__(*args, **kwargs)
+        self.context = context
+        self.__closed = True
         if stream:
             self(stream)
         self.__close_source = close_source
 
     def __call__(self, stream: io.BufferedIOBase):
         self._stream = stream
+        self.__closed = False
         return self
 
+    @property
+    def closed(self) -> bool:
+        return self.__closed
+
     def __getattr__(self, item):
         return getattr(self._stream, item)
 
@@ -83,10 +137,154 @@ class StreamWrapper(io.RawIOBase):
         return self._stream.writable()
 
     def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
         if self.__close_source:
             self._stream.close()
 
 
+class DigestStreamWrapper(StreamWrapper):
+    def __init__(self, algorithm: str = "sha256", *args, **kwargs):
+        self.algorithm = algorithm
+        super().__init__(*args, **kwargs)
+
+    def __call__(self, stream: io.BufferedIOBase):
+        self.__hash = hashlib.new(self.algorithm)
+        return super().__call__(stream)
+
+    def write(self, b: typing.Union[bytes, bytearray]) -> typing.Optional[int]:
+        self.__hash.update(b)
+        return self._stream.write(b)
+
+    def hexdigest(self) -> str:
+        return self.__hash.hexdigest()
+
+
+class CountingStreamWrapper(StreamWrapper):
+    def __call__(self, stream: io.BufferedIOBase):
+        self.count = 0
+        return super().__call__(stream)
+
+    def read(self, *args, **kwargs) -> typing.Optional[bytes]:
+        data = self._stream.read(*args, **kwargs)
+        self.count += len(data or b"")
+        return data
+
+    def write(self, b: typing.Union[bytes, bytearray]) -> typing.Optional[int]:
+        self.count += len(b)
+        return self._stream.write(b)
+
+
+class StreamWrapperChain(StreamWrapper):
+    def __init__(self, *wrappers: StreamWrapper, **kwargs):
+        # ordered from the data producer towards the storage: serializer -> wrappers[0] -> ... -> stream
+        self.__wrappers = wrappers
+        self.__outer = None
+        super().__init__(**kwargs)
+
+    @property
+    def wrappers(self) -> typing.Tuple[StreamWrapper, ...]:
+        return self.__wrappers
+
+    def __call__(self, stream: io.BufferedIOBase):
+        super().__call__(stream)
+        for wrapper in reversed(self.__wrappers):
+            stream = wrapper(stream)
+        self.__outer = stream
+        return self
+
+    def read(self, *args, **kwargs) -> typing.Optional[bytes]:
+        return self.__outer.read(*args, **kwargs)
+
+    def write(self, *args, **kwargs) -> typing.Optional[int]:
+        return self.__outer.write(*args, **kwargs)
+
+    def close(self):
+        if not self.closed:
+            for wrapper in self.__wrappers:
+                wrapper.close()
+        super().close()
+
+
+class StreamWrapperPipeline:
+    def __init__(self, *factories: typing.Callable[..., StreamWrapper]):
+        self.factories = factories
+
+    def __call__(self, **kwargs) -> StreamWrapperChain:
+        return StreamWrapperChain(*[factory(**kwargs) for factory in self.factories])
+
+
+class StreamPipe(io.RawIOBase):
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE, max_chunks: int = 4):
+        super().__init__()
+        self.__chunk_size = chunk_size
+        self.__queue = queue.Queue(maxsize=max_chunks)
+        self.__buffer = bytearray()
+        self.__error = None
+
+    @property
+    def error(self) -> typing.Optional[BaseException]:
+        return self.__error
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: typing.Union[bytes, bytearray]) -> typing.Optional[int]:
+        # the producer may reuse its buffer, so everything queued is copied
+        self.__buffer += b
+        while len(self.__buffer) >= self.__chunk_size:
+            self.__put(bytes(self.__buffer[:self.__chunk_size]))
+            del self.__buffer[:self.__chunk_size]
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            if self.__buffer:
+                self.__put(bytes(self.__buffer))
+                self.__buffer = bytearray()
+            self.__put(None)
+        super().close()
+
+    def abort(self, error: BaseException):
+        self.__error = error
+        super().close()
+        self.__drain()
+        self.__queue.put(None)
+
+    def __put(self, item: typing.Optional[bytes]):
+        while True:
+            if self.__error is not None:
+                raise self.__error
+            try:
+                self.__queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def __drain(self):
+        try:
+            while True:
+                self.__queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        while True:
+            item = self.__queue.get()
+            if self.__error is not None:
+                raise self.__error
+            if item is None:
+                return
+            yield item
+
+    def fail(self, error: BaseException):
+        self.__error = error
+        self.__drain()
+
+
 def find_in_list(l: list, func):
     for item in l:
         if func(item):
@@ -1,9 +1,14 @@
+import contextlib
 import datetime
+import functools
+import json
 import logging
 import sys
 from argparse import ArgumentParser, ArgumentTypeError
 
+from m4m_sync.cache import CachedStore
 from m4m_sync.encrypt import AesStreamWrapper
+from m4m_sync.profiling import Profiler
 from m4m_sync.stores import YaDiskStore, Sensor, Controller
 from m4m_sync.utils import DateTimeRange
 
@@ -31,22 +36,57 @@ def main():
     parser.add_argument("--sensor", type=str, required=True)
     parser.add_argument("--controller", type=str, required=True)
     parser.add_argument("--date", type=valid_date, required=True)
+    parser.add_argument("--end-date", type=valid_date, required=False)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--format", choices=["raw", "records"], default="raw")
     parser.add_argument("--token", required=True)
     parser.add_argument("--output", "-o", default="out.tsv")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--profile-dir", default="profiles")
+    parser.add_argument("--profile-min-seconds", type=float, required=False)
+    parser.add_argument("--profile-min-mb", type=float, required=False)
+    parser.add_argument("--cache-dir", required=False)
+    parser.add_argument("--cache-size", type=int, default=1024, help="megabytes")
 
     args = parser.parse_args()
 
     logger.info("init")
 
     store = YaDiskStore(token=args.token)
+    if args.cache_dir:
+        store = CachedStore(store, root=args.cache_dir, max_size=args.cache_size * 1024 * 1024)
 
-    for data in store.get(
-            sensor=Sensor(id=args.sensor, controller=Controller(mac=args.controller)),
-            range=DateTimeRange.day(args.date),
-            stream_wrapper=AesStreamWrapper(key=args.key.encode("utf-8")) if args.key else None,
-    ):
-        with open(args.output, "wb") as file:
-            file.write(data)
+    sensor = Sensor(id=args.sensor, controller=Controller(mac=args.controller))
+    datetime_range = DateTimeRange(
+        start=DateTimeRange.day(args.date).start,
+        end=DateTimeRange.day(args.end_date or args.date).end,
+    )
+    stream_wrapper_factory = functools.partial(AesStreamWrapper, key=args.key.encode("utf-8")) if args.key else None
+
+    profiler = Profiler(
+        output_dir=args.profile_dir,
+        profile=args.profile,
+        trace_memory=args.trace_memory,
+        min_seconds=args.profile_min_seconds,
+        min_bytes=args.profile_min_mb * 1024 * 1024 if args.profile_min_mb is not None else None,
+    ) if args.profile or args.trace_memory else None
+
+    with open(args.output, "wb") as file, \
+            profiler.section("read-{}".format(sensor)) if profiler else contextlib.nullcontext():
+        if args.format == "records":
+            file.write(b"timestamp\tvalue\n")
+            for record in store.query(sensor, datetime_range, stream_wrapper_factory, workers=args.workers):
+                file.write("{}\t{}\n".format(record.timestamp.isoformat(), json.dumps(record.value)).encode("utf-8"))
+        else:
+            for data in store.read(
+                    sensor,
+                    datetime_range,
+                    stream_wrapper_factory,
+                    workers=args.workers,
+                    read_ahead=args.workers * 2,
+            ):
+                file.write(data)
 
     logger.info("done")
 
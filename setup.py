@@ -6,4 +6,8 @@ setup(
     version='0.1',
     packages=find_packages(),
     install_requires=open(join(dirname(__file__), 'requirements.txt')).readlines(),
+    extras_require={
+        'zstd': ['zstandard==0.12.0'],
+        'lz4': ['lz4==2.2.1'],
+    },
 )
@@ -1,12 +1,19 @@
+import functools
 import logging
 import sys
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
 from m4m_sync import serializers
 
 from database import DatabaseManager
-from m4m_sync.encrypt import AesStreamWrapper
-from m4m_sync.stores import LocalStore, Sensor, Controller
+from m4m_sync.compress import COMPRESSORS
+from m4m_sync.daemon import SyncDaemon
+from m4m_sync.encrypt import AesStreamWrapper, KeyManager
+from m4m_sync.metrics import registry
+from m4m_sync.profiling import Profiler
+from m4m_sync.scheduler import SyncScheduler
+from m4m_sync.stores import LocalStore, Sensor, Controller, PARTITIONS, PARTITION_DAY
+from m4m_sync.utils import StreamWrapperPipeline
 
 logging.basicConfig(
     stream=sys.stdout,
@@ -17,36 +24,185 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def sensor_partition(s):
+    sensor_id, _, granularity = s.partition("=")
+    if granularity not in PARTITIONS:
+        msg = "Not a valid sensor partition: '{0}', expected SENSOR_ID={1}.".format(s, "|".join(PARTITIONS))
+        raise ArgumentTypeError(msg)
+    return sensor_id, granularity
+
+
+def sensor_interval(s):
+    sensor_id, _, seconds = s.partition("=")
+    try:
+        return sensor_id, float(seconds)
+    except ValueError:
+        msg = "Not a valid sensor interval: '{0}', expected SENSOR_ID=SECONDS.".format(s)
+        raise ArgumentTypeError(msg)
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("--db-uri", required=True)
     parser.add_argument("--serializer", default="CsvRawSerializer")
     parser.add_argument("--root", required=True)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--executor", choices=[SyncScheduler.THREAD, SyncScheduler.PROCESS], default=SyncScheduler.THREAD)
+    parser.add_argument("--max-uploads", type=int, required=False)
+    parser.add_argument(
+        "--cipher",
+        choices=[AesStreamWrapper.MODE_CBC, AesStreamWrapper.MODE_GCM],
+        # files written by older versions are cbc and older readers only understand that, gcm is opt-in
+        default=AesStreamWrapper.MODE_CBC,
+    )
+    parser.add_argument("--kdf", choices=sorted(KeyManager.KDFS), required=False, help="gcm only, default: hkdf")
+    parser.add_argument("--compression", choices=["none"] + sorted(COMPRESSORS), default="none")
+    parser.add_argument("--compression-level", type=int, required=False)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--partition", choices=PARTITIONS, default=PARTITION_DAY)
+    parser.add_argument("--sensor-partition", type=sensor_partition, action="append", default=[])
+    parser.add_argument("--verify", action="store_true")
+    parser.add_argument("--realtime-interval", type=float, required=False)
+    parser.add_argument("--create-index", action="store_true")
+    parser.add_argument("--metrics-json", required=False)
+    parser.add_argument("--metrics-textfile", required=False)
+    parser.add_argument("--metrics-pushgateway", required=False)
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--profile-dir", default="profiles")
+    parser.add_argument("--profile-min-seconds", type=float, required=False)
+    parser.add_argument("--profile-min-mb", type=float, required=False)
+    parser.add_argument("--daemon", action="store_true")
+    parser.add_argument("--interval", type=float, default=86400, help="seconds between syncs of a sensor")
+    parser.add_argument("--sensor-interval", type=sensor_interval, action="append", default=[])
+    parser.add_argument("--jitter", type=float, default=0.1, help="fraction of the interval")
+    parser.add_argument("--plan-interval", type=float, default=3600, help="seconds between sensor list reloads")
+    parser.add_argument("--full-interval", type=float, default=86400, help="seconds between full passes of a sensor")
+    parser.add_argument("--health-host", default="0.0.0.0")
+    parser.add_argument("--health-port", type=int, required=False)
 
     args = parser.parse_args()
+    # cbc files have no header to record a derivation in, they always use the sha256 of the key
+    if args.kdf is not None and args.cipher == AesStreamWrapper.MODE_CBC:
+        parser.error("--kdf is only supported with --cipher {}".format(AesStreamWrapper.MODE_GCM))
+    # tracemalloc's peak is process wide, sensors synced on other threads would reset and inflate each other's
+    if args.trace_memory and args.executor == SyncScheduler.THREAD and args.workers > 1:
+        parser.error("--trace-memory needs --executor {} or --workers 1".format(SyncScheduler.PROCESS))
 
     logger.info("init")
 
     db = DatabaseManager(args.db_uri)
-    store = LocalStore(root=args.root)
-
-    for controller in db.get_controllers():
-        c = Controller(name=controller.name, mac=controller.mac)
-        store.prepare_for_sync_controller(c)
-
-        for sensor in db.get_sensors(controller):
-            first_date = db.get_first_sensor_data_date(sensor.id)
-
-            s = Sensor(name=sensor.name, id=sensor.id, controller=c)
-            store.prepare_for_sync_sensor(s)
-
-            store.sync(
-                sensor=s,
-                serializer=getattr(serializers, args.serializer)(),
-                stream_wrapper=AesStreamWrapper(key=db.get_encryption_key()),
-                first_date=first_date,
-                get_data=lambda time_range: db.get_sensor_data(sensor.id, time_range),
-            )
+    if args.create_index:
+        db.create_timestamp_index()
+    else:
+        db.check_timestamp_index()
+    store_factory = functools.partial(LocalStore, root=args.root)
+    store = store_factory()
+
+    partitions = dict(args.sensor_partition)
+
+    def load_sensors():
+        controllers = {}
+        sensors = []
+        watermarks = {}
+        try:
+            for item in db.get_sync_plan():
+                c = controllers.get(item.controller.id)
+                if c is None:
+                    c = controllers[item.controller.id] = Controller(name=item.controller.name, mac=item.controller.mac)
+                    store.prepare_for_sync_controller(c)
+
+                if item.sensor is not None:
+                    sensors.append(Sensor(
+                        name=item.sensor.name,
+                        id=item.sensor.id,
+                        controller=c,
+                        partition=partitions.get(item.sensor.id, args.partition),
+                    ))
+                    watermarks[item.sensor.id] = item.watermark
+        finally:
+            # the plan is read on the main thread's session, left open it idles in a transaction between runs
+            db.close_session()
+        return sensors, watermarks
+
+    wrapper_factories = [
+        functools.partial(
+            AesStreamWrapper,
+            key=KeyManager(db.get_encryption_key(), kdf=KeyManager.KDFS[args.kdf or "hkdf"]),
+            mode=args.cipher,
+        ),
+    ]
+    if args.compression != "none":
+        wrapper_factories.insert(0, functools.partial(COMPRESSORS[args.compression], level=args.compression_level))
+
+    stream_wrapper_factory = StreamWrapperPipeline(*wrapper_factories)
+
+    profiler = Profiler(
+        output_dir=args.profile_dir,
+        profile=args.profile,
+        trace_memory=args.trace_memory,
+        min_seconds=args.profile_min_seconds,
+        min_bytes=args.profile_min_mb * 1024 * 1024 if args.profile_min_mb is not None else None,
+    ) if args.profile or args.trace_memory else None
+
+    scheduler = SyncScheduler(
+        store_factory=store_factory,
+        db_factory=functools.partial(DatabaseManager, args.db_uri, pool_size=args.workers),
+        workers=args.workers,
+        max_uploads=args.max_uploads,
+        executor=args.executor,
+        streaming=args.streaming,
+        profiler=profiler,
+    )
+    export_metrics = functools.partial(
+        registry.export,
+        json_path=args.metrics_json,
+        textfile=args.metrics_textfile,
+        pushgateway=args.metrics_pushgateway,
+    )
+
+    if args.daemon:
+        daemon = SyncDaemon(
+            scheduler=scheduler,
+            load_sensors=load_sensors,
+            serializer_factory=getattr(serializers, args.serializer),
+            stream_wrapper_factory=stream_wrapper_factory,
+            interval=args.interval,
+            sensor_intervals=dict(args.sensor_interval),
+            jitter=args.jitter,
+            plan_interval=args.plan_interval,
+            full_interval=args.full_interval,
+            verify=args.verify,
+            after_run=export_metrics,
+        )
+        if args.health_port:
+            daemon.serve_health(args.health_host, args.health_port)
+        daemon.run()
+        logger.info("done")
+        return
+
+    sensors, watermarks = load_sensors()
+    failed = scheduler.run(
+        sensors=sensors,
+        serializer_factory=getattr(serializers, args.serializer),
+        stream_wrapper_factory=stream_wrapper_factory,
+        verify=args.verify,
+        watermarks=watermarks,
+    )
+    export_metrics()
+
+    if failed:
+        logger.error("failed to sync %d sensor(s)", len(failed))
+        sys.exit(1)
+
+    if args.realtime_interval:
+        logger.info("refreshing recent days every %s seconds", args.realtime_interval)
+        scheduler.watch(
+            sensors=sensors,
+            serializer_factory=getattr(serializers, args.serializer),
+            stream_wrapper_factory=stream_wrapper_factory,
+            interval=args.realtime_interval,
+        )
 
     logger.info("done")
 
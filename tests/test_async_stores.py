@@ -0,0 +1,105 @@
+import asyncio
+import datetime
+import functools
+import io
+import os
+import urllib.parse
+
+from aiohttp import test_utils, web
+
+from m4m_sync.async_stores import AsyncWebDavStore
+from m4m_sync.encrypt import AesStreamWrapper, KeyManager
+from m4m_sync.serializers import CsvRawSerializer
+from m4m_sync.stores import Controller, Sensor, get_file_name_for_day
+from m4m_sync.utils import DateTimeRange
+
+
+class Row:
+    def __init__(self, timestamp: datetime.datetime, value: float):
+        self.data = {"timestamp": timestamp.isoformat(), "value": value}
+        self.signer = None
+        self.sign = None
+
+
+def create_webdav_app(root: str, requests: list) -> web.Application:
+    # just enough of WebDAV for the async store, files live under root
+    async def handle(request: web.Request) -> web.Response:
+        requests.append(request.method)
+        path = urllib.parse.unquote(request.path).strip("/")
+        local_path = os.path.join(root, path)
+
+        if request.method == "PROPFIND":
+            if not os.path.exists(local_path):
+                return web.Response(status=404)
+            hrefs = ["/" + path + "/"]
+            for name in sorted(os.listdir(local_path)):
+                is_dir = os.path.isdir(os.path.join(local_path, name))
+                hrefs.append("/" + os.path.join(path, name).strip("/") + ("/" if is_dir else ""))
+            body = "".join(
+                "<d:response><d:href>{}</d:href></d:response>".format(urllib.parse.quote(href)) for href in hrefs
+            )
+            return web.Response(
+                status=207,
+                body='<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">{}</d:multistatus>'.format(body),
+                content_type="application/xml",
+            )
+        if request.method == "MKCOL":
+            os.makedirs(local_path)
+            return web.Response(status=201)
+        if request.method == "PUT":
+            with open(local_path, "wb") as f:
+                f.write(await request.read())
+            return web.Response(status=201)
+        if request.method == "GET":
+            if not os.path.isfile(local_path):
+                return web.Response(status=404)
+            with open(local_path, "rb") as f:
+                return web.Response(body=f.read())
+        if request.method == "DELETE":
+            os.remove(local_path)
+            return web.Response(status=204)
+        return web.Response(status=405)
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handle)
+    return app
+
+
+def test_sync_and_get_against_local_webdav(tmp_path):
+    requests = []
+    controller = Controller(mac="00:11:22:33:44:55", name="controller")
+    sensor = Sensor(id="1", name="sensor", controller=controller)
+    days = [DateTimeRange.day(-offset) for offset in (2, 3)]
+    rows = {day.start: [Row(day.start + datetime.timedelta(hours=hour), hour) for hour in range(3)] for day in days}
+    stream_wrapper_factory = functools.partial(AesStreamWrapper, key=KeyManager("secret"))
+
+    def get_data_by_days(ranges):
+        return [(current_range, rows.get(current_range.start, [])) for current_range in ranges]
+
+    async def run():
+        server = test_utils.TestServer(create_webdav_app(str(tmp_path), requests))
+        await server.start_server()
+        try:
+            async with AsyncWebDavStore(uri=server.host, port=server.port, max_in_flight=2) as store:
+                await store.prepare_for_sync_controller(controller)
+                await store.prepare_for_sync_sensor(sensor)
+                await store.sync(sensor, CsvRawSerializer(), stream_wrapper_factory, days[-1].start, get_data_by_days)
+
+                uploads = requests.count("PUT")
+                await store.sync(sensor, CsvRawSerializer(), stream_wrapper_factory, days[-1].start, get_data_by_days)
+                assert requests.count("PUT") == uploads
+
+                return await store.get(sensor, DateTimeRange(days[-1].start, days[0].end), stream_wrapper_factory)
+        finally:
+            await server.close()
+
+    result = asyncio.run(run())
+
+    sensor_path = os.path.join(str(tmp_path), "M4M", str(controller), str(sensor))
+    assert sorted(os.listdir(sensor_path)) == sorted([".sensor"] + [get_file_name_for_day(day.start) for day in days])
+    assert len(result) == 2
+    for data, day in zip(result, sorted(days, key=lambda day: day.start)):
+        records = list(CsvRawSerializer().deserialize_records(io.BytesIO(data)))
+        assert [(record.timestamp, record.value) for record in records] == [
+            (datetime.datetime.fromisoformat(row.data["timestamp"]), row.data["value"]) for row in rows[day.start]
+        ]
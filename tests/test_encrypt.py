@@ -0,0 +1,131 @@
+import hashlib
+import io
+import os
+
+import pytest
+from Crypto.Cipher import AES
+
+from m4m_sync.encrypt import AesGcmStreamWrapper, AesStreamWrapper, KeyManager
+
+KEY = "secret"
+CHUNK_SIZE = 64
+
+
+def encrypt(data: bytes, chunk_size: int = CHUNK_SIZE) -> bytes:
+    stream = io.BytesIO()
+    with AesGcmStreamWrapper(key=KeyManager(KEY), chunk_size=chunk_size, context="sensor")(stream) as wrapper:
+        wrapper.write(data)
+    return stream.getvalue()
+
+
+def reader(data: bytes) -> AesGcmStreamWrapper:
+    return AesGcmStreamWrapper(key=KeyManager(KEY))(io.BytesIO(data))
+
+
+def records(data: bytes) -> (bytes, list):
+    # splits a container into its header and its encrypted chunks
+    header_size = len(encrypt(b"")) - AesGcmStreamWrapper.TAG_SIZE
+    body = data[header_size:]
+    record_size = CHUNK_SIZE + AesGcmStreamWrapper.TAG_SIZE
+    return data[:header_size], [body[offset:offset + record_size] for offset in range(0, len(body), record_size)]
+
+
+# the cbc format written before the gcm container, still the one most stored files are in
+def baseline_cbc(data: bytes, key: str) -> bytes:
+    iv = os.urandom(AES.block_size)
+    to_pad = AES.block_size - len(data) % AES.block_size
+    cipher = AES.new(hashlib.sha256(key.encode("utf-8")).digest(), AES.MODE_CBC, iv)
+    return iv + cipher.encrypt(data + bytes([to_pad] * to_pad))
+
+
+SIZES = [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, CHUNK_SIZE * 3]
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_round_trip(size):
+    data = os.urandom(size)
+    encrypted = encrypt(data)
+
+    assert reader(encrypted).read() == data
+    assert AesStreamWrapper(key=KeyManager(KEY))(io.BytesIO(encrypted)).read() == data
+    assert b"".join(reader(encrypted).iter_chunks()) == data
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_seek(size):
+    data = os.urandom(size)
+    encrypted = encrypt(data)
+
+    for offset in range(size + 2):
+        wrapper = reader(encrypted)
+        assert wrapper.seek(offset) == offset
+        assert wrapper.read(5) == data[offset:offset + 5]
+        assert wrapper.read() == data[offset + 5:]
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_read_chunk(size):
+    data = os.urandom(size)
+    wrapper = reader(encrypt(data))
+
+    chunks = [wrapper.read_chunk(index) for index in range(wrapper.chunk_count())]
+    assert b"".join(chunks) == data
+    assert all(len(chunk) == CHUNK_SIZE for chunk in chunks[:-1])
+    with pytest.raises(IndexError):
+        wrapper.read_chunk(wrapper.chunk_count())
+
+
+def test_rejects_dropped_final_chunk():
+    header, chunks = records(encrypt(os.urandom(CHUNK_SIZE * 3)))
+    with pytest.raises(ValueError):
+        reader(header + b"".join(chunks[:-1])).read()
+
+
+def test_rejects_truncated_chunk():
+    encrypted = encrypt(os.urandom(CHUNK_SIZE * 2 + 10))
+    with pytest.raises(ValueError):
+        reader(encrypted[:-5]).read()
+
+
+def test_rejects_reordered_chunks():
+    header, chunks = records(encrypt(os.urandom(CHUNK_SIZE * 3)))
+    with pytest.raises(ValueError):
+        reader(header + chunks[1] + chunks[0] + chunks[2]).read()
+
+
+@pytest.mark.parametrize("position", [0, 8, -1])
+def test_rejects_flipped_bit(position):
+    encrypted = bytearray(encrypt(os.urandom(CHUNK_SIZE * 2)))
+    header_size = len(records(bytes(encrypted))[0])
+    # header bytes are authenticated as associated data, chunk bytes by their tag
+    encrypted[header_size + position if position >= 0 else position] ^= 1
+    with pytest.raises(ValueError):
+        reader(bytes(encrypted)).read()
+
+
+def test_rejects_flipped_header_bit():
+    encrypted = bytearray(encrypt(os.urandom(CHUNK_SIZE)))
+    # the nonce prefix, a change there is only noticed through the tag
+    encrypted[20] ^= 1
+    with pytest.raises(ValueError):
+        reader(bytes(encrypted)).read()
+
+
+@pytest.mark.parametrize("size", [0, 1, AES.block_size, 1000])
+def test_reads_baseline_cbc(size):
+    data = os.urandom(size)
+    assert AesStreamWrapper(key=KEY)(io.BytesIO(baseline_cbc(data, KEY))).read() == data
+    assert AesStreamWrapper(key=KeyManager(KEY))(io.BytesIO(baseline_cbc(data, KEY))).read() == data
+
+
+@pytest.mark.parametrize("size", [0, 1, AES.block_size, 1000])
+def test_writes_baseline_cbc(size):
+    data = os.urandom(size)
+    stream = io.BytesIO()
+    with AesStreamWrapper(key=KEY, mode=AesStreamWrapper.MODE_CBC)(stream) as wrapper:
+        wrapper.write(data)
+
+    encrypted = stream.getvalue()
+    cipher = AES.new(hashlib.sha256(KEY.encode("utf-8")).digest(), AES.MODE_CBC, encrypted[:AES.block_size])
+    plain = cipher.decrypt(encrypted[AES.block_size:])
+    assert plain[:-plain[-1]] == data
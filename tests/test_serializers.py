@@ -0,0 +1,115 @@
+import base64
+import csv
+import io
+import json
+import random
+
+import pytest
+
+from m4m_sync.serializers import BaseSerializer, CsvRawSerializer, CsvVerboseSerializer
+
+
+class Row:
+    def __init__(self, timestamp: str, value, signer: bytes = None, sign: bytes = None):
+        self.data = {"timestamp": timestamp, "value": value}
+        self.signer = signer
+        self.sign = sign
+
+
+# the row at a time encoders the blocked serializers replaced, their output is the format on disk
+def baseline_verbose(data: list) -> bytes:
+    out_stream = io.StringIO()
+    first_value = data[0].data["value"]
+
+    if type(first_value) == dict:
+        csv_writer = csv.DictWriter(out_stream, {"timestamp": 1, **first_value}, delimiter=',', quotechar='"')
+        csv_writer.writeheader()
+        for record in data:
+            csv_writer.writerow({"timestamp": record.data["timestamp"], **record.data["value"]})
+    else:
+        csv_writer = csv.writer(out_stream, delimiter=',', quotechar='"')
+        for row in data:
+            csv_writer.writerow([row.data["timestamp"], row.data["value"]])
+
+    return out_stream.getvalue().encode("utf-8")
+
+
+def baseline_raw(data: list) -> bytes:
+    out_stream = io.BytesIO()
+    out_stream.write("value\tsigner\tsign\n".encode("utf-8"))
+    for row in data:
+        out_stream.write("{value}\t{signer}\t{sign}\n".format(
+            value=json.dumps(row.data),
+            signer=str(base64.b64encode(row.signer), encoding='utf-8') if row.signer else "",
+            sign=str(base64.b64encode(row.sign), encoding='utf-8') if row.sign else "",
+        ).encode("utf-8"))
+    return out_stream.getvalue()
+
+
+def serialize(serializer: BaseSerializer, data: list) -> bytes:
+    out_stream = io.BytesIO()
+    serializer.serialize(out_stream, data)
+    return out_stream.getvalue()
+
+
+def generate_rows(size: int, value) -> list:
+    rnd = random.Random(size)
+    signers = [bytes(rnd.getrandbits(8) for _ in range(32)) for _ in range(3)] + [None, b""]
+    return [
+        Row(
+            timestamp="2020-01-01T00:{:02d}:{:02d}.{:06d}".format(i // 60 % 60, i % 60, i),
+            value=value(rnd, i),
+            signer=rnd.choice(signers),
+            sign=rnd.choice([bytes(rnd.getrandbits(8) for _ in range(64)), None, b""]),
+        )
+        for i in range(size)
+    ]
+
+
+def scalar_value(rnd: random.Random, i: int):
+    return rnd.choice([rnd.random(), i, -5, "str\té,\"", None, 1e22, float("inf"), True])
+
+
+def dict_value(rnd: random.Random, i: int):
+    value = {"a": rnd.random(), "b": rnd.choice([1, None, "x,y\"z", "ü\n", True, float("nan")]), "c": [1, {"k": i}]}
+    if i % 7 == 3:
+        del value["b"]
+    return value
+
+
+def late_timestamp_value(rnd: random.Random, i: int):
+    # only some later rows carry their own timestamp
+    value = {"a": i}
+    if i % 5 == 4:
+        value["timestamp"] = "override-{}".format(i)
+    return value
+
+
+def first_timestamp_value(rnd: random.Random, i: int):
+    return {"timestamp": "override-{}".format(i), "a": i} if i % 3 else {"a": i, "timestamp": None}
+
+
+VALUES = [scalar_value, dict_value, late_timestamp_value, first_timestamp_value]
+
+
+@pytest.mark.parametrize("value", VALUES)
+@pytest.mark.parametrize("size", [1, BaseSerializer.BLOCK_SIZE, BaseSerializer.BLOCK_SIZE * 2 + 3])
+def test_verbose_matches_baseline(value, size):
+    rows = generate_rows(size, value)
+    assert serialize(CsvVerboseSerializer(), rows) == baseline_verbose(rows)
+
+
+@pytest.mark.parametrize("value", VALUES)
+@pytest.mark.parametrize("size", [1, BaseSerializer.BLOCK_SIZE * 2 + 3])
+def test_raw_matches_baseline(value, size):
+    rows = generate_rows(size, value)
+    assert serialize(CsvRawSerializer(), rows) == baseline_raw(rows)
+
+
+def test_verbose_rejects_unknown_fields_like_baseline():
+    rows = [Row("t0", {"a": 1}), Row("t1", {"a": 2, "zz": 3})]
+    with pytest.raises(ValueError) as expected:
+        baseline_verbose(rows)
+    with pytest.raises(ValueError) as actual:
+        serialize(CsvVerboseSerializer(), rows)
+    assert str(actual.value) == str(expected.value)